@@ -0,0 +1,68 @@
+import argparse
+import sys
+import time
+
+import boto3
+from botocore.exceptions import EndpointConnectionError
+
+from src.dynamo import write_items_to_database, write_to_database
+from src.monitor import Timings, create_item
+from tests.test_database import create_table, delete_table
+
+# Wall-clock time of writing monitor history one put_item at a time, compared with the batched write buffer.
+# Needs DynamoDB Local (as used by tests/test_database.py) and exits without timing anything if it is not running.
+# Run from the repository root:
+#   python -m benchmarks.bench_dynamo --counts 10 100 1000
+
+TABLE_NAME = 'MonitorTargetHistory-BENCH'
+TIMINGS = [Timings(None, None, 30), Timings(2.5, 0.8, 3.4)]
+
+
+def create_items(count: int, targets: int):
+    current_time = int(time.time())
+    return [create_item(current_time - i, i % 2 == 0, f'target-{i % targets}.onion', TIMINGS) for i in range(count)]
+
+
+def time_put_item(dynamodb, count: int, targets: int) -> float:
+    items = create_items(count, targets)
+    start = time.perf_counter()
+    for item in items:
+        write_to_database(dynamodb, TABLE_NAME, item)
+    return time.perf_counter() - start
+
+
+def time_write_buffer(dynamodb, count: int, targets: int) -> float:
+    items = create_items(count, targets)
+    start = time.perf_counter()
+    write_items_to_database(dynamodb, TABLE_NAME, items)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--endpoint', default='http://localhost:8000')
+    parser.add_argument('--counts', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--targets', type=int, default=4, help='onion services the items are spread across')
+    args = parser.parse_args()
+
+    # DynamoDB Local accepts any credentials
+    options = {'region_name': 'eu-west-1', 'endpoint_url': args.endpoint,
+               'aws_access_key_id': 'local', 'aws_secret_access_key': 'local'}
+    client = boto3.client('dynamodb', **options)
+    dynamodb = boto3.resource('dynamodb', **options)
+    try:
+        client.list_tables()
+    except EndpointConnectionError:
+        print(f'DynamoDB Local is not running at {args.endpoint}, skipping')
+        sys.exit(0)
+
+    print(f'{"items":>6} {"put_item":>9} {"buffered":>9}')
+    for count in args.counts:
+        results = []
+        for write in [time_put_item, time_write_buffer]:
+            create_table(client, TABLE_NAME)
+            client.get_waiter('table_exists').wait(TableName=TABLE_NAME)
+            results.append(write(dynamodb, count, args.targets))
+            delete_table(client, TABLE_NAME)
+            client.get_waiter('table_not_exists').wait(TableName=TABLE_NAME)
+        print(f'{count:>6} {results[0]:>9.2f} {results[1]:>9.2f}')
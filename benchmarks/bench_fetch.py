@@ -0,0 +1,33 @@
+import argparse
+import contextlib
+import io
+import time
+
+import pgp_manager
+from benchmarks.fake_s3 import FakeS3Client, create_directory
+
+# Wall-clock time of pgp_manager.get_all_entries against an in-memory S3 stand-in.
+# Run from the repository root:
+#   python -m benchmarks.bench_fetch --latency 0.02 --counts 100 500 1000 --workers 1 10 32
+
+
+def time_fetch(count: int, workers: int, latency: float) -> float:
+    client = FakeS3Client({'data': create_directory(count)}, latency=latency)
+    start = time.perf_counter()
+    # silence the NoSuchKey logging for contacts without a fingerprint
+    with contextlib.redirect_stdout(io.StringIO()):
+        pgp_manager.get_all_entries(client, 'data', max_workers=workers)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated seconds per S3 request')
+    parser.add_argument('--counts', type=int, nargs='+', default=[100, 500, 1000])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 10, 32])
+    args = parser.parse_args()
+
+    print(f'{"keys":>6} {"workers":>8} {"seconds":>9}')
+    for count in args.counts:
+        for workers in args.workers:
+            print(f'{count:>6} {workers:>8} {time_fetch(count, workers, args.latency):>9.2f}')
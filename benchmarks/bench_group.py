@@ -0,0 +1,59 @@
+import argparse
+import locale
+import random
+import timeit
+
+from pgp_listing import EnhancedEntry, group_entries
+
+# Grouping and sorting of synthetic contacts, comparing the dict-of-lists approach with the single sorted pass.
+# Run from the repository root:
+#   python -m benchmarks.bench_group --count 100000 --locale en_GB.UTF-8
+
+LAST_NAMES = ['Whalen', 'Ábel', 'Östberg', 'oakley', 'Ng', 'García', 'Åkesson', 'Zhang', 'Ødegaard', "O'Neill"]
+OTHER_NAMES = ['Kate', 'Zoë', 'Élodie', 'Sam', 'José', 'Mary Jane', 'Łukasz', 'Aisha']
+
+
+# the grouping as it was before group_entries, which dropped one-character last names, kept here for comparison
+def legacy_sort_entries(unsorted_entries):
+    alphabetical_groups = {}
+    for entry in unsorted_entries:
+        if len(entry.last_name) > 1:
+            grouping = entry.last_name[0].upper()
+            alphabetical_groups.setdefault(grouping, []).append(entry)
+    return alphabetical_groups
+
+
+def legacy_create_ordered_groups(groups):
+    alphabetical_groups = sorted(groups)
+    for key in alphabetical_groups:
+        entries = groups[key]
+        yield key, sorted(entries, key=lambda entry: entry.last_name)
+
+
+def create_entries(count: int):
+    rng = random.Random(0)
+    return [
+        EnhancedEntry(rng.choice(OTHER_NAMES), f'{rng.choice(LAST_NAMES)}{i}', 'pk', 'fp', 'email')
+        for i in range(count)
+    ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--locale', help='also time locale-aware collation with this LC_COLLATE locale')
+    args = parser.parse_args()
+
+    entries = create_entries(args.count)
+    timings = [
+        ('legacy', lambda: list(legacy_create_ordered_groups(legacy_sort_entries(entries)))),
+        ('single pass', lambda: group_entries(entries))
+    ]
+    if args.locale:
+        locale.setlocale(locale.LC_COLLATE, args.locale)
+        timings.append(('locale', lambda: group_entries(entries, locale_aware=True)))
+
+    for name, function in timings:
+        best = min(timeit.repeat(function, number=1, repeat=args.repeat))
+        print(f'{name:>12}: {best * 1000:8.1f} ms for {args.count} entries ({best / args.count * 1e6:.2f} us/entry)')
@@ -0,0 +1,65 @@
+import argparse
+import tracemalloc
+
+from pgp_listing import EnhancedEntry, Group
+from pgp_manager import Entry
+
+# Memory held per contact by the listing records, compared with the dict-backed classes they replaced.
+# Run from the repository root:
+#   python -m benchmarks.bench_memory --count 100000
+
+
+# the records as they were before they became NamedTuples, kept here for comparison
+class LegacyEntry:
+    def __init__(self, name, publickey, fingerprint):
+        self.name = name
+        self.publickey = publickey
+        self.fingerprint = fingerprint
+
+
+class LegacyEnhancedEntry:
+    def __init__(self, other_names, last_name, publickey, fingerprint, email, raw_email=''):
+        self.other_names = other_names
+        self.last_name = last_name
+        self.publickey = publickey
+        self.fingerprint = fingerprint
+        self.email = email
+        self.raw_email = raw_email
+
+
+class LegacyGroup:
+    def __init__(self, heading, entries):
+        self.heading = heading
+        self.entries = entries
+
+
+# the strings are created up front and shared, so only the records themselves are measured
+def measure(count: int, create) -> int:
+    fields = [(f'Contact{i} Surname{i}', f'Contact{i}', f'Surname{i}', f'PublicKeys/Contact{i} Surname{i}.pub.txt')
+              for i in range(count)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = create(fields)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return after - before
+
+
+def create_records(entry_class, enhanced_class, group_class):
+    def create(fields):
+        entries = [entry_class(name, key, 'fp') for name, other, last, key in fields]
+        enhanced = [enhanced_class(other, last, key, 'fp', 'email', 'email') for name, other, last, key in fields]
+        return entries, group_class('C', enhanced)
+    return create
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+
+    for name, create in [('legacy', create_records(LegacyEntry, LegacyEnhancedEntry, LegacyGroup)),
+                         ('records', create_records(Entry, EnhancedEntry, Group))]:
+        size = measure(args.count, create)
+        print(f'{name:>8}: {size / 1024 / 1024:7.1f} MiB for {args.count} contacts ({size / args.count:.0f} bytes/contact)')
@@ -0,0 +1,79 @@
+import argparse
+import os
+import re
+import timeit
+
+from fingerprint_parser import parse_fingerprint_files
+from pgp_manager import decode_fingerprint
+
+# Micro-benchmark of fingerprint parsing over a synthetic corpus of .fpr.txt bodies.
+# Run from the repository root:
+#   python -m benchmarks.bench_parse --count 10000
+
+EDGE_CASE = os.path.join(os.path.dirname(__file__), '..', 'tests', 'edge_case.fpr.txt')
+
+
+# the parsers as they were before fingerprint_parser, which ran on str(bytes), kept here for comparison
+def legacy_parse_fingerprint(raw_fingerprint):
+    if isinstance(raw_fingerprint, str):
+        split_str = raw_fingerprint.split('Key fingerprint = ', 1)
+        if len(split_str) > 1:
+            return split_str[1][:50]
+        else:
+            pattern = re.compile(r'([A-Z0-9]{4}\s{1,2}){9}[A-Z0-9]{4}')
+            match = re.search(pattern, raw_fingerprint)
+            if match:
+                return match.group()
+    return ''
+
+
+def legacy_parse_email(raw_fingerprint):
+    if isinstance(raw_fingerprint, str):
+        if '<' in raw_fingerprint:
+            return raw_fingerprint[raw_fingerprint.find('<')+1:raw_fingerprint.find('>')]
+        email_result = [string for string in raw_fingerprint.split(' ') if '@' in string]
+        if len(email_result) == 1:
+            email_end = max([
+                email_result[0].find('guardian.co.uk') + 14,
+                email_result[0].find('guardian.com') + 12]
+            )
+            return email_result[0][:email_end]
+    return ''
+
+
+def create_corpus(count: int):
+    with open(EDGE_CASE, 'rb') as fobj:
+        edge_case = fobj.read()
+    corpus = []
+    for i in range(count):
+        if i % 10 == 0:
+            body = edge_case
+        else:
+            body = (
+                f'pub   4096R/85FBBD09 2019-03-11\n'
+                f'      Key fingerprint = 6FD2 E4C9 71AD B9BB 1573  85EA 383B C341 85FB {i % 65536:04X}\n'
+                f'uid       [ unknown] Contact {i} <contact{i}@theguardian.com>\n'
+                f'sub   2048R/8FA007E8 2019-03-11\n'
+            ).encode()
+        corpus.append(body)
+    return corpus
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = create_corpus(args.count)
+
+    # fetch_fingerprint used to return str(bytes) and now decodes the body, so include that in the timings
+    def legacy():
+        return [(legacy_parse_fingerprint(str(body)), legacy_parse_email(str(body))) for body in corpus]
+
+    def batch():
+        return parse_fingerprint_files(decode_fingerprint(body) for body in corpus)
+
+    for name, function in [('legacy', legacy), ('batch', batch)]:
+        best = min(timeit.repeat(function, number=1, repeat=args.repeat))
+        print(f'{name:>8}: {best * 1000:8.1f} ms for {args.count} files ({best / args.count * 1e6:.2f} us/file)')
@@ -0,0 +1,49 @@
+import argparse
+import subprocess
+import sys
+import tempfile
+
+import template_env
+
+# Cold-start cost of loading and rendering the PGP listing template, with and without precompiled templates.
+# Every sample runs in a fresh interpreter so nothing is cached between them.
+# Run from the repository root:
+#   python -m benchmarks.bench_render --entries 1000 --repeat 5
+
+SAMPLE = '''
+import time
+start = time.perf_counter()
+import template_env
+from pgp_listing import EnhancedEntry, Group, build_search_index
+env = template_env.create_environment({compiled_dir!r})
+loaded = time.perf_counter()
+template = env.get_template('pgp-listing.html')
+entries = [EnhancedEntry('Contact', f'Surname{{i}}', 'pk', 'fp', 'email') for i in range({entries})]
+groups = [Group('S', entries)]
+template.render(path='pgp/', groups=groups, search_index=build_search_index(groups))
+rendered = time.perf_counter()
+print(loaded - start, rendered - loaded)
+'''
+
+
+def sample(compiled_dir: str, entries: int):
+    code = SAMPLE.format(compiled_dir=compiled_dir, entries=entries)
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    return [float(value) for value in output.split()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as compiled_dir:
+        template_env.compile_templates(compiled_dir)
+        modes = [('filesystem', '/nonexistent'), ('compiled', compiled_dir)]
+        print(f'{"loader":>10} {"import ms":>10} {"first render ms":>16}')
+        for name, directory in modes:
+            samples = [sample(directory, args.entries) for _ in range(args.repeat)]
+            imported = min(s[0] for s in samples) * 1000
+            rendered = min(s[1] for s in samples) * 1000
+            print(f'{name:>10} {imported:>10.1f} {rendered:>16.1f}')
@@ -0,0 +1,89 @@
+import argparse
+import subprocess
+import sys
+
+# Cold and warm start cost of the Lambda entry point.
+# The import breakdown comes from `python -X importtime`; the handler is then invoked twice in a fresh
+# interpreter against the in-memory S3 stand-in, so the second invocation shows the warm container cost.
+# Run from the repository root:
+#   python -m benchmarks.bench_startup --keys 500
+
+HANDLER_SAMPLE = '''
+import contextlib, io, os, tempfile, time
+start = time.perf_counter()
+import pgp_listing
+imported = time.perf_counter()
+
+import pgp_manager
+from benchmarks.fake_s3 import FakeS3Client, FakeSession, create_directory
+
+client = FakeS3Client({{'data': create_directory({keys}), 'public': {{}}}})
+real_create_session = pgp_manager.create_session
+
+
+# build a real boto3 session so that its cost is counted, but serve requests from the stand-in
+def create_session(profile=None):
+    real_create_session(profile)
+    return FakeSession(client)
+
+
+pgp_manager.create_session = create_session
+os.environ.update({{
+    'DATA_BUCKET_NAME': 'data',
+    'PUBLIC_BUCKET_NAME': 'public',
+    'FINGERPRINT_CACHE_DIR': tempfile.mkdtemp()
+}})
+timings = [imported - start]
+for _ in range(2):
+    # force a full render on both invocations so they do the same work
+    client.buckets['public'].pop('manifest.json', None)
+    invoked = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        pgp_listing.lambda_handler({{}}, None)
+    timings.append(time.perf_counter() - invoked)
+print(*timings)
+'''
+
+
+def import_breakdown(module: str, top: int):
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True).stderr
+    total, children = 0, []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        # each level of nesting indents the module name by two more spaces
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        # a module is reported after everything it imports, so the rows collected since the
+        # previous top-level module are the direct imports of this one
+        if depth == 0:
+            if name.strip() == module:
+                total = int(cumulative_us)
+                break
+            children = []
+        elif depth == 1:
+            children.append((int(cumulative_us), name.strip()))
+    return total, sorted(children, reverse=True)[:top]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=8)
+    args = parser.parse_args()
+
+    total, rows = import_breakdown('pgp_listing', args.top)
+    print(f'import pgp_listing: {total / 1000:.1f} ms (-X importtime)')
+    for cumulative, name in rows:
+        print(f'  {name:<30} {cumulative / 1000:8.1f} ms')
+
+    code = HANDLER_SAMPLE.format(keys=args.keys)
+    samples = []
+    for _ in range(args.repeat):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+        samples.append([float(value) for value in output.split()])
+    imported, cold, warm = [min(sample[i] for sample in samples) * 1000 for i in range(3)]
+    print(f'handler with {args.keys} keys: import {imported:.1f} ms, cold invocation {cold:.1f} ms, '
+          f'warm invocation {warm:.1f} ms')
@@ -0,0 +1,123 @@
+import base64
+import datetime
+import hashlib
+import io
+import time
+import threading
+
+from botocore.exceptions import ClientError
+
+# !! ~~ Only use this module for local benchmarking ~~ !!
+
+
+def no_such_key(operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}}, operation)
+
+
+# An in-memory stand-in for the parts of the S3 client used by pgp_manager.
+# Every request sleeps for `latency` seconds to mimic a network round trip.
+class FakeS3Client:
+    def __init__(self, buckets=None, latency: float = 0.0):
+        self.buckets = buckets if buckets is not None else {}
+        self.latency = latency
+        self.calls = {}
+        # the time each object was last written, defaulting to when the client was created
+        self.modified = {}
+        self.created = datetime.datetime.now(datetime.timezone.utc)
+        self._lock = threading.Lock()
+
+    def _request(self, operation: str):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _describe(self, bucket: str, key: str):
+        body = self.buckets[bucket][key]
+        return {
+            'Key': key,
+            'Size': len(body),
+            'ETag': f'"{hashlib.md5(body).hexdigest()}"',
+            'LastModified': self.modified.get((bucket, key), self.created)
+        }
+
+    def _write(self, bucket: str, key: str, body: bytes):
+        self.buckets.setdefault(bucket, {})[key] = body
+        self.modified[(bucket, key)] = datetime.datetime.now(datetime.timezone.utc)
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', ContinuationToken=None, MaxKeys=1000):
+        self._request('list_objects_v2')
+        keys = sorted(key for key in self.buckets.get(Bucket, {}) if key.startswith(Prefix) and key > StartAfter)
+        start = int(ContinuationToken) if ContinuationToken else 0
+        page = keys[start:start + MaxKeys]
+        resp = {'KeyCount': len(page)}
+        if page:
+            resp['Contents'] = [self._describe(Bucket, key) for key in page]
+        if start + MaxKeys < len(keys):
+            resp['NextContinuationToken'] = str(start + MaxKeys)
+        return resp
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self._request('get_object')
+        try:
+            body = self.buckets[Bucket][Key]
+        except KeyError:
+            raise no_such_key('GetObject')
+        etag = self._describe(Bucket, Key)['ETag']
+        if IfNoneMatch == etag:
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+        return {'Body': io.BytesIO(body), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._request('put_object')
+        body = Body.encode() if isinstance(Body, str) else Body
+        self._write(Bucket, Key, body)
+        return {'ETag': self._describe(Bucket, Key)['ETag']}
+
+    def copy_object(self, CopySource, Bucket, Key, **kwargs):
+        self._request('copy_object')
+        try:
+            body = self.buckets[CopySource['Bucket']][CopySource['Key']]
+        except KeyError:
+            raise no_such_key('CopyObject')
+        self._write(Bucket, Key, body)
+        return {'CopyObjectResult': {'ETag': self._describe(Bucket, Key)['ETag']}}
+
+    def delete_objects(self, Bucket, Delete):
+        self._request('delete_objects')
+        assert len(Delete['Objects']) <= 1000
+        for obj in Delete['Objects']:
+            self.buckets.get(Bucket, {}).pop(obj['Key'], None)
+            self.modified.pop((Bucket, obj['Key']), None)
+        return {} if Delete.get('Quiet') else {'Deleted': Delete['Objects']}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+        self._request('upload_file')
+        with open(Filename, 'rb') as fobj:
+            self._write(Bucket, Key, fobj.read())
+
+
+class FakeSession:
+    def __init__(self, client: FakeS3Client):
+        self._client = client
+
+    def client(self, service_name: str, **kwargs):
+        return self._client
+
+
+def create_directory(count: int, with_fingerprint: float = 0.8) -> dict:
+    objects = {}
+    for i in range(count):
+        name = f'Contact{i:05d} Surname{i:05d}'
+        objects[f'PublicKeys/{name}.pub.txt'] = (
+            f'-----BEGIN PGP PUBLIC KEY BLOCK-----\n\n'
+            f'{base64.b64encode(name.encode()).decode()}\n'
+            f'-----END PGP PUBLIC KEY BLOCK-----\n'
+        ).encode()
+        if i < count * with_fingerprint:
+            objects[f'Fingerprints/{name}.fpr.txt'] = (
+                f'pub   4096R/85FBBD09 2019-03-11\n'
+                f'      Key fingerprint = 6FD2 E4C9 71AD B9BB 1573  85EA 383B C341 85FB {i:04X}\n'
+                f'uid       [ unknown] {name} <contact{i}@theguardian.com>\n'
+            ).encode()
+    return objects
@@ -33,10 +33,20 @@ cd target/packages
 zip -r9 $OLDPWD/target/lambda/${APP}.zip .
 cd $OLDPWD
 
+# compile the Jinja templates ahead of time so the Lambda can load them as Python modules
+PYTHONPATH=target/packages python3 template_env.py target/compiled_templates
+cd target
+zip -gr lambda/${APP}.zip compiled_templates
+cd $OLDPWD
+
 zip -gr target/lambda/${APP}.zip static
 zip -gr target/lambda/${APP}.zip templates
 zip -g target/lambda/${APP}.zip pgp_listing.py
 zip -g target/lambda/${APP}.zip pgp_manager.py
+zip -g target/lambda/${APP}.zip fingerprint_parser.py
+zip -g target/lambda/${APP}.zip fingerprint_cache.py
+zip -g target/lambda/${APP}.zip key_directory.py
+zip -g target/lambda/${APP}.zip template_env.py
 
 # Create build.json containing RiffRaff metadata
 cat >build.json << EOF
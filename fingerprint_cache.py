@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from typing import Optional, Tuple
+
+# Warm Lambda containers keep /tmp between invocations, so by default the cache lives there
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'secure-contact-fingerprints')
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+
+
+# An on-disk cache of fingerprint bodies, keyed by S3 key and validated by ETag.
+# Each key is stored as a small JSON file so that a cached body is never separated from its ETag.
+class FingerprintCache:
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_age: int = DEFAULT_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    # returns the cached (ETag, body) for the key, or None if it is not cached
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        try:
+            with open(self.path(key), encoding='utf-8') as fobj:
+                cached = json.load(fobj)
+        except (OSError, ValueError):
+            return None
+        if cached.get('Key') != key:
+            return None
+        return cached['ETag'], cached['Body']
+
+    # mark an entry as recently used so that it is the last to be evicted
+    def touch(self, key: str) -> None:
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+
+    def put(self, key: str, etag: str, body: str) -> None:
+        # write to a temporary file first so that concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as fobj:
+            json.dump({'Key': key, 'ETag': etag, 'Body': body}, fobj)
+        os.replace(tmp_path, self.path(key))
+
+    # remove entries that have not been used for max_age, then the least recently used until under max_bytes
+    def evict(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        removed = 0
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if now - mtime < self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
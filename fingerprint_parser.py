@@ -0,0 +1,88 @@
+import re
+
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+# Fingerprints are written by `gpg --fingerprint` as ten groups of four characters, with two spaces
+# between the fifth and sixth group, which makes them exactly 50 characters long.
+FINGERPRINT_LABEL = 'Key fingerprint = '
+FINGERPRINT_LENGTH = 50
+
+# The common shapes are handled with str.find and slicing, which is several times cheaper than a regex search.
+# These patterns are only needed for the unusual shapes and are compiled once at import time.
+BARE_FINGERPRINT = re.compile(r'(?:[A-Z0-9]{4}\s{1,2}){9}[A-Z0-9]{4}')
+ANGLE_EMAIL = re.compile(r'<([^<>\s]+@[^<>\s]+)>')
+BARE_EMAIL = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+
+
+class Uid(NamedTuple):
+    name: str
+    email: str
+
+
+# one is built for every contact on every parse, so it is a plain tuple rather than a dict-backed class
+class FingerprintRecord(NamedTuple):
+    fingerprint: str
+    email: str
+    uids: Tuple[Uid, ...]
+
+
+EMPTY_RECORD = FingerprintRecord('', '', ())
+
+
+# a uid line looks like `uid       [ unknown] Kate Whalen <Kate.Whalen@theguardian.com>`,
+# although the trust level, the name and the angle brackets are all optional
+def parse_uid(line: str) -> Uid:
+    if line.startswith('['):
+        line = line[line.find(']') + 1:].lstrip()
+    start = line.rfind('<')
+    if start != -1 and line.endswith('>') and '@' in line[start:]:
+        return Uid(line[:start].rstrip(), line[start + 1:-1])
+    match = BARE_EMAIL.search(line) if '@' in line else None
+    if match:
+        return Uid(line[:match.start()].strip(), match.group())
+    return Uid(line, '')
+
+
+def find_uids(text: str) -> Tuple[Uid, ...]:
+    uids = []
+    start = text.find('uid ')
+    while start != -1:
+        end = text.find('\n', start)
+        if end == -1:
+            end = len(text)
+        # only count `uid` at the start of a line, ignoring indentation
+        if not text[text.rfind('\n', 0, start) + 1:start].strip():
+            uids.append(parse_uid(text[start + 4:end].strip()))
+        start = text.find('uid ', end)
+    return tuple(uids)
+
+
+def find_fingerprint(text: str) -> str:
+    start = text.find(FINGERPRINT_LABEL)
+    if start != -1:
+        start += len(FINGERPRINT_LABEL)
+        return text[start:start + FINGERPRINT_LENGTH]
+    match = BARE_FINGERPRINT.search(text)
+    return match.group() if match else ''
+
+
+# the primary email is the first uid with an email, falling back to any email in the file
+def find_email(text: str, uids: Tuple[Uid, ...]) -> str:
+    for uid in uids:
+        if uid.email:
+            return uid.email
+    if '@' not in text:
+        return ''
+    match = ANGLE_EMAIL.search(text) or BARE_EMAIL.search(text)
+    return match.group(match.lastindex or 0) if match else ''
+
+
+def parse_fingerprint_file(raw_fingerprint: Optional[str]) -> FingerprintRecord:
+    if not isinstance(raw_fingerprint, str):
+        return EMPTY_RECORD
+    uids = find_uids(raw_fingerprint)
+    return FingerprintRecord(find_fingerprint(raw_fingerprint), find_email(raw_fingerprint, uids), uids)
+
+
+def parse_fingerprint_files(raw_fingerprints: Iterable[Optional[str]]) -> List[FingerprintRecord]:
+    return [parse_fingerprint_file(raw_fingerprint) for raw_fingerprint in raw_fingerprints]
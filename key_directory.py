@@ -0,0 +1,80 @@
+import base64
+import binascii
+import hashlib
+import json
+import string
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# A compact JSON document listing every contact, so tooling does not have to scrape the HTML page
+DIRECTORY_KEY = 'directory.json'
+
+# The OpenPGP Web Key Directory, using the advanced method's layout so that several email domains can be served:
+# https://datatracker.ietf.org/doc/draft-koch-openpgp-webkey-service/
+WKD_PREFIX = '.well-known/openpgpkey/'
+ZBASE32_ALPHABET = 'ybndrfg8ejkmcpqxot1uwisza345h769'
+# WKD only lowercases the ASCII letters of the local part
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+ARMOR_BEGIN = '-----BEGIN PGP PUBLIC KEY BLOCK-----'
+ARMOR_END = '-----END PGP PUBLIC KEY BLOCK-----'
+
+
+def build_directory(records: Iterable[Dict[str, Any]]) -> str:
+    return json.dumps({'keys': list(records)}, separators=(',', ':'), ensure_ascii=False)
+
+
+def zbase32(data: bytes) -> str:
+    bits = ''.join(f'{byte:08b}' for byte in data)
+    bits += '0' * (-len(bits) % 5)
+    return ''.join(ZBASE32_ALPHABET[int(bits[i:i + 5], 2)] for i in range(0, len(bits), 5))
+
+
+def wkd_hash(local_part: str) -> str:
+    return zbase32(hashlib.sha1(local_part.translate(ASCII_LOWER).encode('utf-8')).digest())
+
+
+def wkd_domain(email: str) -> str:
+    return email.rsplit('@', 1)[1].lower()
+
+
+def wkd_key(email: str) -> Optional[str]:
+    if email.count('@') != 1 or not all(email.split('@')):
+        return None
+    local_part, domain = email.split('@')
+    return f'{WKD_PREFIX}{domain.lower()}/hu/{wkd_hash(local_part)}'
+
+
+# WKD serves keys in binary, but the data bucket holds ASCII-armored exports from gpg
+def dearmor(armored: Optional[str]) -> Optional[bytes]:
+    if not armored:
+        return None
+    start = armored.find(ARMOR_BEGIN)
+    end = armored.find(ARMOR_END, start)
+    if start == -1 or end == -1:
+        return None
+    # the armor headers are separated from the data by the first blank line
+    lines = armored[start + len(ARMOR_BEGIN):end].strip().splitlines()
+    if '' in (line.strip() for line in lines):
+        lines = lines[[line.strip() for line in lines].index('') + 1:]
+    # the last line may be the CRC24 checksum, which is not part of the key
+    data = ''.join(line.strip() for line in lines if not line.startswith('='))
+    try:
+        return base64.b64decode(data, validate=True) or None
+    except binascii.Error:
+        return None
+
+
+# returns the binary keys to publish for each address, plus an empty policy file for each domain.
+# Several keys for the same address are concatenated into one file, as WKD allows.
+def build_wkd(keys: Iterable[Tuple[str, Optional[str]]]) -> Dict[str, bytes]:
+    files: Dict[str, List[bytes]] = {}
+    for email, armored in keys:
+        key = wkd_key(email) if email else None
+        binary = dearmor(armored)
+        if key is None or binary is None:
+            continue
+        files.setdefault(f'{WKD_PREFIX}{wkd_domain(email)}/policy', [])
+        if binary not in files.setdefault(key, []):
+            files[key].append(binary)
+    return {key: b''.join(parts) for key, parts in files.items()}
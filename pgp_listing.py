@@ -1,68 +1,49 @@
+import hashlib
 import os
+import re
 import shutil
 import json
+import sys
 import pgp_manager
-import re
+import fingerprint_cache
+import fingerprint_parser
+import key_directory
+import template_env
+import locale
+import time
+import unicodedata
 
 from pgp_manager import Entry
-from jinja2 import Environment, FileSystemLoader, select_autoescape, Markup
+from fingerprint_parser import parse_fingerprint_file
+from jinja2 import Markup
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import groupby
 from urllib import parse
 
-from typing import Dict, List, Union
-
-
-class Group:
-    def __init__(self, heading, entries):
-        self.heading = heading
-        self.entries = entries
-
-    def __eq__(self, other):
-        if not isinstance(other, Group):
-            return NotImplemented
-
-        return self.heading == other.heading and self.entries == other.entries
-
-    def __hash__(self):
-        # Make class instances usable as items in hashable collections
-        return hash((self.heading, self.entries))
-
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 
-class EnhancedEntry:
-    def __init__(self, other_names, last_name, publickey, fingerprint, email):
-        self.other_names = other_names
-        self.last_name = last_name
-        self.publickey = publickey
-        self.fingerprint = fingerprint
-        self.email = email
 
-    def __str__(self):
-        return f'{str(self.__class__)}: {str(self.__dict__)}'
+class EnhancedEntry(NamedTuple):
+    other_names: str
+    last_name: str
+    publickey: str
+    fingerprint: str
+    # obscured for the page; raw_email is only published to the key directory
+    email: Optional[str]
+    raw_email: str = ''
 
-    def __eq__(self, other):
-        if not isinstance(other, EnhancedEntry):
-            return NotImplemented
 
-        return self.other_names == other.other_names and self.last_name == other.last_name \
-            and self.publickey == other.publickey and self.fingerprint == other.fingerprint \
-            and self.email == other.email
+# entries is always stored as a tuple, so that groups are immutable and hashable
+class Group(NamedTuple('Group', [('heading', str), ('entries', Tuple[EnhancedEntry, ...])])):
+    __slots__ = ()
 
-    def __hash__(self):
-        # Make class instances usable as items in hashable collections
-        return hash((self.other_names, self.last_name, self.publickey, self.fingerprint, self.email))
+    def __new__(cls, heading: str, entries: Iterable[EnhancedEntry]):
+        return super().__new__(cls, heading, tuple(entries))
 
 
-# TODO: handle nonetype better than empty string
 def parse_fingerprint(raw_fingerprint: Union[None, str]) -> str:
-    if isinstance(raw_fingerprint, str):
-        split_str = raw_fingerprint.split('Key fingerprint = ', 1)
-        if len(split_str) > 1:
-            return split_str[1][:50]
-        else:
-            pattern = re.compile(r'([A-Z0-9]{4}\s{1,2}){9}[A-Z0-9]{4}')
-            match = re.search(pattern, raw_fingerprint)
-            if match:
-                return match.group()
-    return ''
+    return parse_fingerprint_file(raw_fingerprint).fingerprint
 
 
 def obscure_email(raw_email: Union[None, str]) -> str:
@@ -73,23 +54,7 @@ def obscure_email(raw_email: Union[None, str]) -> str:
 
 
 def parse_email(raw_fingerprint: Union[None, str]) -> str:
-    if isinstance(raw_fingerprint, str):
-        if '<' in raw_fingerprint:
-            return raw_fingerprint[raw_fingerprint.find('<')+1:raw_fingerprint.find('>')]
-        # once we split the string, there should only be one that contains a @ symbol
-        # so we can use list comprehension to find the one we want...
-        email_result = [string for string in raw_fingerprint.split(' ') if '@' in string]
-        # there should be exactly one result or something has gone horribly wrong...
-        if len(email_result) == 1:
-            # why not rstrip? Strange, there is a single edge case that is really stubborn
-            # so instead we are going to find the index of the expected end of the email
-            email_end = max([
-                email_result[0].find('guardian.co.uk') + 14,
-                email_result[0].find('guardian.com') + 12]
-            )
-            email = email_result[0][:email_end]
-            return email
-    return ''
+    return parse_fingerprint_file(raw_fingerprint).email
 
 
 # Names are hard and given the sample dataset, this works for the current publickeys
@@ -97,55 +62,272 @@ def parse_email(raw_fingerprint: Union[None, str]) -> str:
 def enhance_entry(entry: Entry) -> EnhancedEntry:
     other_names, last_name = entry.name.rsplit(' ', 1)
     key_url = parse.quote(entry.publickey)
-    fingerprint = parse_fingerprint(entry.fingerprint)
-    email = obscure_email(parse_email(entry.fingerprint))
-    return EnhancedEntry(other_names, last_name, key_url, fingerprint, email)
+    record = parse_fingerprint_file(entry.fingerprint)
+    email = obscure_email(record.email)
+    return EnhancedEntry(other_names, last_name, key_url, record.fingerprint, email, record.email)
+
+
+DEFAULT_ENHANCED_CACHE_SIZE = 10000
+
+
+# Remembers enhance_entry for contacts whose name, key and fingerprint have not changed, evicting the least
+# recently used. The fingerprint is identified by its ETag from the listing when there is one, which saves
+# hashing the body. Lambda keeps the module between warm invocations, so only changed contacts are parsed again.
+class EnhancedEntryCache:
+    def __init__(self, max_size: int = DEFAULT_ENHANCED_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def enhance(self, entry: Entry, etag: Optional[str] = None) -> EnhancedEntry:
+        if etag is None and entry.fingerprint is not None:
+            etag = hashlib.md5(entry.fingerprint.encode('utf-8')).hexdigest()
+        key = (entry.name, entry.publickey, etag)
+        enhanced = self.entries.get(key)
+        if enhanced is not None:
+            self.entries.move_to_end(key)
+            return enhanced
+        enhanced = enhance_entry(entry)
+        self.entries[key] = enhanced
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return enhanced
+
 
+def fingerprint_etag(listing: Dict[str, Dict[str, Any]], entry: Entry) -> Optional[str]:
+    obj = listing.get(pgp_manager.fingerprint_key(entry.name))
+    return obj['ETag'] if obj and entry.fingerprint is not None else None
 
-def sort_entries(unsorted_entries: List[EnhancedEntry]) -> Dict[str, List[EnhancedEntry]]:
+
+# the combining diacritical mark blocks, which the page's filter script also strips from what is typed
+COMBINING_MARKS = re.compile('[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]')
+
+
+def normalize_name(name: str) -> str:
+    # fold case and strip accents so that typing "jose" finds "José". This uses lower() rather than casefold()
+    # because the filter script can only apply toLowerCase() to what is typed, and casefold() turns "ß" into "ss"
+    if name.isascii():
+        return name.lower()
+    return COMBINING_MARKS.sub('', unicodedata.normalize('NFKD', name)).lower()
+
+
+def sort_entries(unsorted_entries: Iterable[EnhancedEntry]) -> Dict[str, List[EnhancedEntry]]:
     alphabetical_groups = {}
     for entry in unsorted_entries:
-        if len(entry.last_name) > 1:
-            grouping = entry.last_name[0].upper()
-            alphabetical_groups.setdefault(grouping, []).append(entry)
+        alphabetical_groups.setdefault(group_heading(entry), []).append(entry)
     return alphabetical_groups
 
 
 def create_ordered_groups(groups: Dict[str, List[EnhancedEntry]]) -> List[Group]:
-    alphabetical_groups = sorted(groups)
-    for key in alphabetical_groups:
-        entries = groups[key]
-        yield Group(key, sorted(entries, key=lambda entry: entry.last_name))
+    return group_entries(entry for key in groups for entry in groups[key])
+
+
+def group_heading(entry: EnhancedEntry, locale_aware: bool = False) -> str:
+    # a locale may sort accented letters separately, e.g. Swedish puts Ö after Z, so they keep their own heading
+    initial = entry.last_name[:1] if locale_aware else normalize_name(entry.last_name[:1])[:1]
+    return initial.upper() or '#'
+
+
+# Contacts are ordered by heading, last name and then other names, ignoring case and accents, with the names as
+# written breaking any ties so the page does not change with the order the fingerprints arrive in.
+# With locale_aware, names are compared with the current LC_COLLATE locale instead.
+# The heading is always the second item, so that group_entries can group on it.
+def collation_key(entry: EnhancedEntry, locale_aware: bool = False) -> Tuple[str, ...]:
+    if locale_aware:
+        heading = group_heading(entry, locale_aware)
+        return (locale.strxfrm(heading), heading, locale.strxfrm(entry.last_name),
+                locale.strxfrm(entry.other_names), entry.last_name, entry.other_names)
+    last_name = normalize_name(entry.last_name)
+    heading = last_name[:1].upper() or '#'
+    return heading, heading, last_name, normalize_name(entry.other_names), entry.last_name, entry.other_names
+
 
+# sort once by the collation key, which starts with the heading, so each group is a single run of entries
+def group_entries(entries: Iterable[EnhancedEntry], locale_aware: bool = False) -> List[Group]:
+    keyed = sorted(((collation_key(entry, locale_aware), entry) for entry in entries), key=lambda pair: pair[0])
+    return [Group(heading, (entry for _, entry in run)) for heading, run in groupby(keyed, key=lambda pair: pair[0][1])]
 
-THIS_DIR = os.path.dirname(os.path.abspath(__file__))
-env = Environment(
-    loader=FileSystemLoader(THIS_DIR + '/templates/public'),
-    trim_blocks=True,
-    autoescape=select_autoescape(['html', 'xml'])
-)
 
+# one list of normalized names per group, in page order, so the filter script never has to read the DOM
+def build_search_index(groups: Iterable[Group]) -> List[List[str]]:
+    return [[normalize_name(f'{entry.other_names} {entry.last_name}') for entry in group.entries]
+            for group in groups]
 
-def render_page(path: str, groups: List[Group]):
-    root_template = env.get_template('pgp-listing.html')
-    return root_template.render(path=path, groups=groups)
+
+def render_page(path: str, groups: Iterable[Group], assets: Optional[Dict[str, str]] = None,
+                shards: Optional[List[Tuple[str, str]]] = None):
+    groups = list(groups)
+    root_template = template_env.get_template('pgp-listing.html')
+    return root_template.render(path=path, groups=groups, assets=assets, shards=shards,
+                                search_index=build_search_index(groups))
+
+
+SHARD_PREFIX = 'letters/'
+
+
+def shard_key(heading: str) -> str:
+    return f'{SHARD_PREFIX}{heading}.html'
+
+
+# a light index page linking to one page per letter, keyed by where each page is published.
+# The letter pages live one level down, so they refer to the index and assets through shard_path.
+def render_shards(path: str, shard_path: str, groups: Iterable[Group],
+                  assets: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    groups = list(groups)
+    shards = [(group.heading, shard_key(group.heading)) for group in groups]
+    pages = {'index.html': render_page(path, [], assets, shards)}
+    for group in groups:
+        pages[shard_key(group.heading)] = render_page(shard_path, [group], assets, shards)
+    return pages
+
+
+def directory_record(entry: EnhancedEntry, listing: Dict[str, Dict[str, Any]]) -> Dict[str, str]:
+    return {
+        'name': f'{entry.other_names} {entry.last_name}',
+        'fingerprint': entry.fingerprint,
+        'email': entry.raw_email,
+        'url': f'/pgp/{entry.publickey}',
+        'etag': listing[parse.unquote(entry.publickey)]['ETag'].strip('"')
+    }
+
+
+# the JSON directory and the Web Key Directory, built from the same entries as the page, keyed by where they
+# are published. Only the keys of contacts with an email address are fetched, and those are usually cached.
+def render_key_directory(publisher: pgp_manager.Publisher, bucket: str, groups: Iterable[Group],
+                         listing: Dict[str, Dict[str, Any]],
+                         cache: Optional[fingerprint_cache.FingerprintCache] = None) -> Dict[str, Tuple[bytes, str]]:
+    entries = [entry for group in groups for entry in group.entries]
+    directory = key_directory.build_directory(directory_record(entry, listing) for entry in entries)
+    documents = {key_directory.DIRECTORY_KEY: (directory.encode('utf-8'), 'application/json')}
+
+    with_email = [entry for entry in entries if entry.raw_email]
+    armored = publisher.fetch_public_keys(bucket, [parse.unquote(entry.publickey) for entry in with_email],
+                                          listing, cache)
+    wkd = key_directory.build_wkd((entry.raw_email, armored[parse.unquote(entry.publickey)]) for entry in with_email)
+    for key, body in wkd.items():
+        documents[key] = (body, 'application/octet-stream')
+    return documents
+
+
+# uploads the documents that have changed and returns when the oldest of them was published,
+# so that the manifest asks for them all to be refreshed before any of them expires
+def publish_documents(publisher: pgp_manager.Publisher, bucket: str, documents: Dict[str, Tuple[bytes, str]],
+                      published: Dict[str, Dict[str, Any]], now: int) -> int:
+    oldest = now
+    for key, (body, content_type) in documents.items():
+        uploaded = publisher.upload_document(bucket, key, body, content_type, published,
+                                             compress=True, cache_control=pgp_manager.PAGE_CACHE_CONTROL)
+        if not uploaded:
+            oldest = min(oldest, int(published[key]['LastModified'].timestamp()))
+    return oldest
+
+
+# LC_COLLATE is process wide, so it is set once here rather than while sorting; returns whether a locale is in use
+def set_collation_locale(name: Optional[str]) -> bool:
+    if not name:
+        return False
+    locale.setlocale(locale.LC_COLLATE, name)
+    return True
+
+
+@lru_cache(maxsize=None)
+def get_enhanced_entry_cache() -> EnhancedEntryCache:
+    return EnhancedEntryCache()
+
+
+# Lambda reuses the module between warm invocations, so the session and client are only created once per container
+@lru_cache(maxsize=None)
+def get_aws_session():
+    return pgp_manager.create_session()
+
+
+# every phase of the run shares the publisher's pooled S3 client
+@lru_cache(maxsize=None)
+def get_publisher() -> pgp_manager.Publisher:
+    concurrency = int(os.getenv('PUBLISH_CONCURRENCY', pgp_manager.DEFAULT_MAX_WORKERS))
+    return pgp_manager.Publisher(get_aws_session(), concurrency)
+
+
+# Identifies everything besides the listing that shapes the published documents: the templates,
+# the code that renders them and the collation locale.
+@lru_cache(maxsize=None)
+def render_version(collation_locale: Optional[str] = None) -> str:
+    digest = hashlib.sha256(f'{collation_locale}\0'.encode())
+    templates = sorted(os.path.join(root, name) for root, _, names in os.walk(template_env.TEMPLATE_DIR)
+                       for name in names)
+    modules = [module.__file__ for module in
+               [pgp_manager, key_directory, template_env, fingerprint_parser, sys.modules[__name__]]]
+    for path in templates + modules:
+        with open(path, 'rb') as fobj:
+            digest.update(fobj.read())
+    return digest.hexdigest()
 
 
 def lambda_handler(event, context) -> None:
     DATA_BUCKET_NAME = os.getenv('DATA_BUCKET_NAME')
     PUBLIC_BUCKET_NAME = os.getenv('PUBLIC_BUCKET_NAME')
+    DELETE_DRY_RUN = os.getenv('DELETE_DRY_RUN', 'false').lower() == 'true'
+    FINGERPRINT_CACHE_DIR = os.getenv('FINGERPRINT_CACHE_DIR', fingerprint_cache.DEFAULT_CACHE_DIR)
+    SHARDED_OUTPUT = os.getenv('SHARDED_OUTPUT', 'false').lower() == 'true'
+    COLLATION_LOCALE = os.getenv('COLLATION_LOCALE')
+
+    publisher = get_publisher()
+    now = int(time.time())
+
+    # compare the data bucket with what we published last time and only publish what has changed
+    previous = publisher.load_manifest(PUBLIC_BUCKET_NAME)
+    listing = publisher.get_listing(DATA_BUCKET_NAME)
+    manifest = {}
+
+    stale_keys = []
+    for key, obj in listing.items():
+        if key.startswith('PublicKeys/'):
+            if pgp_manager.is_stale(previous, key, obj['ETag'], now):
+                stale_keys.append(Entry(pgp_manager.parse_name(key), key, None))
+            else:
+                manifest[key] = previous[key]
+
+    # keys that failed to copy are left out of the manifest so that the next run tries them again
+    copied = publisher.copy_keys(DATA_BUCKET_NAME, PUBLIC_BUCKET_NAME, stale_keys)
+    for key, error in copied.items():
+        if error is None:
+            pgp_manager.record_published(manifest, key, listing[key]['ETag'], now)
+
+    published = publisher.get_published_objects(PUBLIC_BUCKET_NAME)
+    orphaned_keys = pgp_manager.find_orphaned_keys(published, listing)
+    publisher.delete_keys(PUBLIC_BUCKET_NAME, orphaned_keys, DELETE_DRY_RUN)
+    assets = publisher.publish_static_assets(PUBLIC_BUCKET_NAME, 'static/', 'static/', published)
+
+    # the page only needs rendering when a key, fingerprint or static asset has been added, removed or changed,
+    # or when a deploy changes how it is rendered
+    digest = pgp_manager.listing_digest(listing, assets, SHARDED_OUTPUT, render_version(COLLATION_LOCALE))
+    if pgp_manager.is_stale(previous, 'index.html', digest, now):
+        # each entry is enhanced as soon as its fingerprint arrives, so only the enhanced entries are held for sorting
+        cache = fingerprint_cache.FingerprintCache(FINGERPRINT_CACHE_DIR)
+        all_entries = publisher.generate_entries(DATA_BUCKET_NAME, listing, cache)
+        enhanced_entries = get_enhanced_entry_cache()
+        all_groups = group_entries((enhanced_entries.enhance(entry, fingerprint_etag(listing, entry))
+                                    for entry in all_entries), set_collation_locale(COLLATION_LOCALE))
+        if SHARDED_OUTPUT:
+            pages = render_shards('pgp/', '/pgp/', all_groups, assets)
+        else:
+            pages = {'index.html': render_page('pgp/', all_groups, assets)}
+        documents = {key: (page.encode('utf-8'), 'text/html') for key, page in pages.items()}
+        documents.update(render_key_directory(publisher, DATA_BUCKET_NAME, all_groups, listing, cache))
+        cache.evict()
 
-    aws_session = pgp_manager.create_session()
-    all_entries = pgp_manager.get_all_entries(aws_session, DATA_BUCKET_NAME)
-
-    pgp_manager.copy_keys_to_public_bucket(aws_session, DATA_BUCKET_NAME, PUBLIC_BUCKET_NAME, all_entries)
-    pgp_manager.upload_files(aws_session, PUBLIC_BUCKET_NAME, 'static/', 'static/')
+        # a changed listing can still render identical documents, in which case their uploads are skipped
+        published_at = publish_documents(publisher, PUBLIC_BUCKET_NAME, documents, published, now)
+        pgp_manager.record_published(manifest, 'index.html', digest, published_at)
 
-    enhanced_entries = [enhance_entry(entry) for entry in all_entries]
-    all_groups = create_ordered_groups(sort_entries(enhanced_entries))
-    index_page = render_page('pgp/', all_groups)
+        # letters that no longer have any contacts, or every letter when sharding is switched off,
+        # and the Web Key Directory entries of contacts who have left or changed address
+        orphaned_documents = pgp_manager.find_orphaned_keys(published, documents, SHARD_PREFIX) + \
+            pgp_manager.find_orphaned_keys(published, documents, key_directory.WKD_PREFIX)
+        publisher.delete_keys(PUBLIC_BUCKET_NAME, orphaned_documents, DELETE_DRY_RUN)
+    else:
+        manifest['index.html'] = previous['index.html']
 
-    pgp_manager.upload_html(aws_session, PUBLIC_BUCKET_NAME, 'index.html', index_page)
+    publisher.save_manifest(PUBLIC_BUCKET_NAME, manifest)
 
 
 if __name__ == '__main__':
@@ -158,11 +340,13 @@ if __name__ == '__main__':
 
     print(f'Using configuration for stage={STAGE} and profile={AWS_PROFILE}')
 
-    session = pgp_manager.create_session(AWS_PROFILE)
-    entries = pgp_manager.get_all_entries(session, DATA_BUCKET_NAME)
+    FINGERPRINT_CACHE_DIR = os.getenv('FINGERPRINT_CACHE_DIR', fingerprint_cache.DEFAULT_CACHE_DIR)
+    SHARDED_OUTPUT = os.getenv('SHARDED_OUTPUT', 'false').lower() == 'true'
 
-    enhanced = [enhance_entry(entry) for entry in entries]
-    groups = create_ordered_groups(sort_entries(enhanced))
+    publisher = pgp_manager.Publisher(pgp_manager.create_session(AWS_PROFILE))
+    cache = fingerprint_cache.FingerprintCache(FINGERPRINT_CACHE_DIR)
+    entries = publisher.iter_all_entries(DATA_BUCKET_NAME, cache)
+    groups = group_entries((enhance_entry(entry) for entry in entries), set_collation_locale(os.getenv('COLLATION_LOCALE')))
 
     if os.path.exists('./build'):
         print('Build: removing old build file')
@@ -172,9 +356,12 @@ if __name__ == '__main__':
     shutil.copytree('./static', './build/static')
 
     print('Build: creating templates')
-    text_file = open("build/index.html", "w")
-    text_file.write(render_page('', groups))
-    text_file.close()
+    pages = render_shards('', '../', groups) if SHARDED_OUTPUT else {'index.html': render_page('', groups)}
+    for page_key, page in pages.items():
+        os.makedirs(os.path.dirname(os.path.join('build', page_key)), exist_ok=True)
+        with open(os.path.join('build', page_key), 'w') as text_file:
+            text_file.write(page)
+    cache.evict()
 
     print('Build: Done!')
 
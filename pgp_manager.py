@@ -1,28 +1,22 @@
-import boto3, os, json
+import boto3, os, io, json, gzip, hashlib, time
 
-from typing import Dict, List, Any, Union
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Any, NamedTuple, Optional, Union
 from boto3 import Session
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from fingerprint_cache import FingerprintCache
 
+# botocore keeps up to 10 connections per client by default, so more workers than this just queue for a connection
+DEFAULT_MAX_WORKERS = 10
 
-class Entry:
-    def __init__(self, name, publickey, fingerprint):
-        self.name = name
-        self.publickey = publickey
-        self.fingerprint = fingerprint
 
-    def __str__(self):
-        return f'{str(self.__class__)}: {str(self.__dict__)}'
-
-    def __eq__(self, other):
-        if not isinstance(other, Entry):
-            return NotImplemented
-
-        return self.name == other.name and self.publickey == other.publickey and self.fingerprint == other.fingerprint
-
-    def __hash__(self):
-        # Make class instances usable as items in hashable collections
-        return hash((self.name, self.publickey, self.fingerprint))
+# Entries are immutable tuples, which keeps them small and hashable when a large directory is held in memory
+class Entry(NamedTuple):
+    name: str
+    publickey: str
+    fingerprint: Optional[str]
 
 
 # assumes the uploaded public key is named after the contact
@@ -30,27 +24,78 @@ def parse_name(key: str) -> str:
     return key.replace('PublicKeys/', '').replace('.pub.txt', '')
 
 
-# Not all public keys will have a corresponding fingerprint
-def fetch_fingerprint(s3_client, bucket: str, name: str) -> Union[None, str]:
-    key = f'Fingerprints/{name}.fpr.txt'
+def fingerprint_key(name: str) -> str:
+    return f'Fingerprints/{name}.fpr.txt'
+
+
+def log_missing_key(function: str, key: str) -> None:
+    log = json.dumps({
+        'app': 'secure-contact',
+        'function': function,
+        'message': f'NoSuchKey: {key}'
+    })
+    print(log)
+
+
+# gpg writes fingerprint files as UTF-8; a stray byte should not stop the listing from building
+def decode_fingerprint(body: bytes) -> str:
+    return body.decode('utf-8', errors='replace')
+
+
+# With a cache, a body whose ETag matches the listing is used without a request, and any other
+# cached body is revalidated with a conditional GET that returns 304 Not Modified if it is unchanged.
+# A missing key raises the ClientError from S3.
+def fetch_text(s3_client, bucket: str, key: str, cache: Optional[FingerprintCache] = None,
+               etag: Optional[str] = None) -> str:
+    cached = cache.get(key) if cache else None
+    if cached and cached[0] == etag:
+        cache.touch(key)
+        return cached[1]
+    kwargs = {'Bucket': bucket, 'Key': key}
+    if cached:
+        kwargs['IfNoneMatch'] = cached[0]
+    try:
+        s3_obj = s3_client.get_object(**kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified') and cached:
+            cache.touch(key)
+            return cached[1]
+        raise e
+    body = decode_fingerprint(s3_obj['Body'].read())
+    if cache:
+        cache.put(key, s3_obj['ETag'], body)
+    return body
+
+
+# Not all public keys will have a corresponding fingerprint.
+def fetch_fingerprint(s3_client, bucket: str, name: str, cache: Optional[FingerprintCache] = None,
+                      etag: Optional[str] = None) -> Union[None, str]:
+    key = fingerprint_key(name)
     try:
-        s3_obj = s3_client.get_object(Bucket=bucket, Key=key)
-        return str(s3_obj['Body'].read())
+        return fetch_text(s3_client, bucket, key, cache, etag)
     except ClientError as e:
         if e.response['Error']['Code'] == 'NoSuchKey':
-            log = json.dumps({
-                'app': 'secure-contact',
-                'function': 'fetch_fingerprint',
-                'message': f'NoSuchKey: {key}'
-            })
-            print(log)
+            log_missing_key('fetch_fingerprint', key)
         else:
             raise e
 
 
-def generate_entry(s3_client, bucket: str, key: str) -> Entry:
+# list the Fingerprints/ prefix once so that we only request the fingerprints that exist
+def get_fingerprint_index(s3_client, bucket: str) -> Dict[str, Dict[str, Any]]:
+    return {obj['Key']: obj for obj in get_matching_s3_objects(s3_client, bucket, 'Fingerprints/')}
+
+
+def generate_entry(s3_client, bucket: str, key: str, fingerprint_index: Optional[Dict[str, Any]] = None,
+                   cache: Optional[FingerprintCache] = None) -> Entry:
     contact_name = parse_name(key)
-    fingerprint = fetch_fingerprint(s3_client, bucket, contact_name)
+    etag = None
+    if fingerprint_index is not None:
+        obj = fingerprint_index.get(fingerprint_key(contact_name))
+        if obj is None:
+            log_missing_key('generate_entry', fingerprint_key(contact_name))
+            return Entry(contact_name, key, None)
+        etag = obj['ETag']
+    fingerprint = fetch_fingerprint(s3_client, bucket, contact_name, cache, etag)
     return Entry(contact_name, key, fingerprint)
 
 
@@ -97,17 +142,93 @@ def should_be_public(entry: Entry) -> bool:
     return True
 
 
+def log_copy_failure(key: str, error: str) -> None:
+    log = json.dumps({
+        'app': 'secure-contact',
+        'function': 'copy_keys_to_public_bucket',
+        'message': f'{error}: {key}'
+    })
+    print(log)
+
+
+# the keys are only a few KB, so a single CopyObject request avoids the HEAD and multipart overhead of client.copy
+def copy_key(s3_client, source_bucket: str, dest_bucket: str, key: str) -> Optional[str]:
+    copy_source = {
+        'Bucket': source_bucket,
+        'Key': key
+    }
+    try:
+        s3_client.copy_object(CopySource=copy_source, Bucket=dest_bucket, Key=key)
+    except ClientError as e:
+        error = e.response['Error']['Code']
+        log_copy_failure(key, error)
+        return error
+
+
 # should copy a list of s3 objects from one bucket to another, preserving the directory structure
-def copy_keys_to_public_bucket(session: Session, source_bucket: str, dest_bucket: str, entries: List[Entry]) -> None:
-    # could we set a lifecycle on the bucket to deal with old keys?
-    client = session.client('s3')
-    for entry in entries:
-        if should_be_public(entry):
-            copy_source = {
-                'Bucket': source_bucket,
-                'Key': entry.publickey
-            }
-            client.copy(copy_source, dest_bucket, entry.publickey)
+# returns the error code for each key that could not be copied, or None if the copy succeeded
+def copy_keys_to_public_bucket(s3_client, source_bucket: str, dest_bucket: str, entries: List[Entry],
+                               max_workers: int = DEFAULT_MAX_WORKERS) -> Dict[str, Optional[str]]:
+    keys = [entry.publickey for entry in entries if should_be_public(entry)]
+    if max_workers <= 1:
+        results = [copy_key(s3_client, source_bucket, dest_bucket, key) for key in keys]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(lambda key: copy_key(s3_client, source_bucket, dest_bucket, key), keys))
+    return dict(zip(keys, results))
+
+
+# armored public keys are ASCII, so they share the fingerprint cache; a key removed since the listing is None
+def fetch_public_keys(s3_client, bucket: str, keys: List[str], listing: Dict[str, Dict[str, Any]],
+                      max_workers: int = DEFAULT_MAX_WORKERS,
+                      cache: Optional[FingerprintCache] = None) -> Dict[str, Optional[str]]:
+    def fetch(key: str) -> Optional[str]:
+        try:
+            return fetch_text(s3_client, bucket, key, cache, listing.get(key, {}).get('ETag'))
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise e
+            log_missing_key('fetch_public_keys', key)
+
+    if max_workers <= 1:
+        results = [fetch(key) for key in keys]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(fetch, keys))
+    return dict(zip(keys, results))
+
+
+# DeleteObjects accepts up to 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+
+# keys that are still published but have been removed from the data bucket
+def find_orphaned_keys(published: Dict[str, Dict[str, Any]], listing: Dict[str, Dict[str, Any]],
+                       prefix: str = 'PublicKeys/') -> List[str]:
+    return sorted(key for key in published if key.startswith(prefix) and key not in listing)
+
+
+# returns the error code for each key that could not be deleted; a dry run only logs the keys
+def delete_keys(s3_client, bucket: str, keys: List[str], dry_run: bool = False) -> Dict[str, str]:
+    log = json.dumps({
+        'app': 'secure-contact',
+        'function': 'delete_keys',
+        'message': f'{"would delete" if dry_run else "deleting"} {len(keys)} orphaned keys',
+        'keys': keys
+    })
+    print(log)
+    errors = {}
+    if dry_run:
+        return errors
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[start:start + DELETE_BATCH_SIZE]
+        resp = s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+        )
+        for error in resp.get('Errors', []):
+            errors[error['Key']] = error['Code']
+    return errors
 
 
 def get_content_type(filename: str) -> str:
@@ -121,27 +242,285 @@ def get_content_type(filename: str) -> str:
         return ''
 
 
-def upload_html(session: Session, bucket: str, key: str, body: str) -> None:
-    client = session.client('s3')
-    content_type = 'text/html'
-    client.put_object(Body=body, Bucket=bucket, Key=key, ContentType=content_type)
+# The public bucket expires objects after 7 days and the Lambda does not run at weekends,
+# so anything published more than 3 days ago is published again before it can expire.
+REFRESH_AFTER = 3 * 24 * 60 * 60
+
+
+# list the public bucket once so that uploads can be compared with what is already published
+def get_published_objects(s3_client, bucket: str, prefix: str = '') -> Dict[str, Dict[str, Any]]:
+    return {obj['Key']: obj for obj in get_matching_s3_objects(s3_client, bucket, prefix)}
+
+
+# S3 uses the MD5 of the content as the ETag for objects uploaded in a single part
+def needs_upload(published: Dict[str, Dict[str, Any]], key: str, body: bytes, now: float) -> bool:
+    obj = published.get(key)
+    if obj is None or obj['ETag'].strip('"') != hashlib.md5(body).hexdigest():
+        return True
+    return now - obj['LastModified'].timestamp() >= REFRESH_AFTER
+
+
+def log_upload(function: str, uploaded: List[str], skipped: List[str]) -> None:
+    log = json.dumps({
+        'app': 'secure-contact',
+        'function': function,
+        'message': f'uploaded {len(uploaded)} and skipped {len(skipped)} unchanged files',
+        'uploaded': uploaded
+    })
+    print(log)
+
+
+# Assets are published under names that include a hash of their content, so edge caches can keep them forever
+# and a changed file is picked up as soon as the page refers to its new name.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+PAGE_CACHE_CONTROL = 'public, max-age=300'
+COMPRESSIBLE_TYPES = ('text/html', 'text/css', 'application/json')
+
+
+# a fixed mtime keeps the compressed bytes, and therefore the ETag, the same for the same input
+def gzip_bytes(body: bytes) -> bytes:
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as gzip_file:
+        gzip_file.write(body)
+    return buffer.getvalue()
+
+
+def hashed_name(filename: str, body: bytes) -> str:
+    stem, extension = os.path.splitext(filename)
+    return f'{stem}.{hashlib.md5(body).hexdigest()[:12]}{extension}'
+
+
+# returns True if the object was uploaded, or False if the published copy is already up to date
+def put_if_changed(s3_client, bucket: str, key: str, body: bytes, published: Optional[Dict[str, Dict[str, Any]]],
+                   now: float, content_type: str, compress: bool = False, cache_control: Optional[str] = None) -> bool:
+    extra_args = {'ContentType': content_type}
+    if compress and content_type in COMPRESSIBLE_TYPES:
+        body = gzip_bytes(body)
+        extra_args['ContentEncoding'] = 'gzip'
+    if cache_control:
+        extra_args['CacheControl'] = cache_control
+    if published is not None and not needs_upload(published, key, body, now):
+        return False
+    s3_client.put_object(Body=body, Bucket=bucket, Key=key, **extra_args)
+    return True
 
 
-def upload_files(session: Session, bucket: str, path: str, prefix: str = '') -> None:
-    client = session.client('s3')
+def upload_document(s3_client, bucket: str, key: str, body: bytes, content_type: str,
+                    published: Optional[Dict[str, Dict[str, Any]]] = None, compress: bool = False,
+                    cache_control: Optional[str] = None) -> bool:
+    uploaded = put_if_changed(s3_client, bucket, key, body, published, time.time(),
+                              content_type, compress, cache_control)
+    if not uploaded:
+        log_upload('upload_document', [], [key])
+    return uploaded
+
+
+def upload_html(s3_client, bucket: str, key: str, body: str, published: Optional[Dict[str, Dict[str, Any]]] = None,
+                compress: bool = False, cache_control: Optional[str] = None) -> bool:
+    return upload_document(s3_client, bucket, key, body.encode('utf-8'), 'text/html', published,
+                           compress, cache_control)
+
+
+def upload_files(s3_client, bucket: str, path: str, prefix: str = '',
+                 published: Optional[Dict[str, Dict[str, Any]]] = None) -> List[str]:
+    if published is None:
+        published = get_published_objects(s3_client, bucket, prefix)
+    now = time.time()
+    uploaded, skipped = [], []
     for subdir, dirs, files in os.walk(path):
         for file in files:
             content_type = get_content_type(file)
             full_path = os.path.join(subdir, file)
             s3path = prefix + file
-            client.upload_file(full_path, bucket, s3path, ExtraArgs={'ContentType': content_type})
+            with open(full_path, 'rb') as fobj:
+                body = fobj.read()
+            if put_if_changed(s3_client, bucket, s3path, body, published, now, content_type):
+                uploaded.append(s3path)
+            else:
+                skipped.append(s3path)
+    log_upload('upload_files', uploaded, skipped)
+    return uploaded
+
+
+# publish every static file under its hashed name, compressed where that helps, and
+# return the name each file was published under so that pages can refer to it
+def publish_static_assets(s3_client, bucket: str, path: str, prefix: str = '',
+                          published: Optional[Dict[str, Dict[str, Any]]] = None) -> Dict[str, str]:
+    if published is None:
+        published = get_published_objects(s3_client, bucket, prefix)
+    now = time.time()
+    assets, uploaded, skipped = {}, [], []
+    for subdir, dirs, files in os.walk(path):
+        for file in files:
+            full_path = os.path.join(subdir, file)
+            with open(full_path, 'rb') as fobj:
+                body = fobj.read()
+            assets[file] = hashed_name(file, body)
+            s3path = prefix + assets[file]
+            if put_if_changed(s3_client, bucket, s3path, body, published, now, get_content_type(file),
+                              compress=True, cache_control=IMMUTABLE_CACHE_CONTROL):
+                uploaded.append(s3path)
+            else:
+                skipped.append(s3path)
+    log_upload('publish_static_assets', uploaded, skipped)
+    return assets
+
+
+# list everything the listing is built from, keyed by S3 key, so we can compare ETags between runs
+def get_listing(s3_client, bucket: str) -> Dict[str, Dict[str, Any]]:
+    listing = {obj['Key']: obj for obj in get_matching_s3_objects(s3_client, bucket, 'PublicKeys/')}
+    listing.update(get_fingerprint_index(s3_client, bucket))
+    return listing
+
+
+# Yield an Entry for each key as soon as its fingerprint has been fetched, in the order the keys arrive.
+# Keys are consumed lazily and at most twice as many fetches as workers are in flight, so the keys can come
+# straight from a paginated listing without holding the whole directory in memory.
+# boto3 clients are thread safe, so the workers share one client.
+def iter_entries(s3_client, bucket: str, keys: Iterable[str], fingerprint_index: Optional[Dict[str, Any]] = None,
+                 max_workers: int = DEFAULT_MAX_WORKERS, cache: Optional[FingerprintCache] = None) -> Iterator[Entry]:
+    if max_workers <= 1:
+        for key in keys:
+            yield generate_entry(s3_client, bucket, key, fingerprint_index, cache)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        for key in keys:
+            in_flight.append(executor.submit(generate_entry, s3_client, bucket, key, fingerprint_index, cache))
+            if len(in_flight) >= max_workers * 2:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def generate_entries(s3_client, bucket: str, listing: Dict[str, Dict[str, Any]],
+                     max_workers: int = DEFAULT_MAX_WORKERS, cache: Optional[FingerprintCache] = None) -> Iterator[Entry]:
+    public_keys = (key for key in listing if key.startswith('PublicKeys/'))
+    return iter_entries(s3_client, bucket, public_keys, listing, max_workers, cache)
+
+
+# stream an Entry for each contact, fetching fingerprints while the public keys are still being listed
+def iter_all_entries(s3_client, data_bucket: str, max_workers: int = DEFAULT_MAX_WORKERS,
+                     cache: Optional[FingerprintCache] = None) -> Iterator[Entry]:
+    fingerprints = get_fingerprint_index(s3_client, data_bucket)
+    public_keys = get_matching_s3_keys(s3_client, data_bucket, 'PublicKeys/')
+    return iter_entries(s3_client, data_bucket, public_keys, fingerprints, max_workers, cache)
 
 
 # fetch all of the required data from S3 and return a List containing an Entry for each contact
-def get_all_entries(session: Session, data_bucket: str) -> List[Entry]:
-    client = session.client('s3')
-    public_keys = list(get_matching_s3_keys(client, data_bucket, 'PublicKeys/'))
-    return [generate_entry(client, data_bucket, key) for key in public_keys]
+def get_all_entries(s3_client, data_bucket: str, max_workers: int = DEFAULT_MAX_WORKERS,
+                    cache: Optional[FingerprintCache] = None) -> List[Entry]:
+    return list(iter_all_entries(s3_client, data_bucket, max_workers, cache))
+
+
+# The manifest records the ETag of every object we published on the last run and when we published it.
+# It lives in the public bucket, so it must never contain anything that is not already on the page.
+MANIFEST_KEY = 'manifest.json'
+
+
+def load_manifest(s3_client, bucket: str) -> Dict[str, Dict[str, Any]]:
+    try:
+        s3_obj = s3_client.get_object(Bucket=bucket, Key=MANIFEST_KEY)
+        return json.loads(s3_obj['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return {}
+        raise e
+
+
+def save_manifest(s3_client, bucket: str, manifest: Dict[str, Dict[str, Any]]) -> None:
+    body = json.dumps(manifest, sort_keys=True)
+    s3_client.put_object(Body=body, Bucket=bucket, Key=MANIFEST_KEY, ContentType='application/json')
+
+
+def is_stale(manifest: Dict[str, Dict[str, Any]], key: str, etag: str, now: int) -> bool:
+    record = manifest.get(key)
+    return record is None or record['ETag'] != etag or now - record['Published'] >= REFRESH_AFTER
+
+
+def record_published(manifest: Dict[str, Dict[str, Any]], key: str, etag: str, now: int) -> None:
+    manifest[key] = {'ETag': etag, 'Published': now}
+
+
+# a single value that changes whenever any object in the listing is added, removed or modified
+def listing_digest(listing: Dict[str, Dict[str, Any]], assets: Optional[Dict[str, str]] = None,
+                   sharded: bool = False, render_version: str = '') -> str:
+    digest = hashlib.sha256()
+    for key in sorted(listing):
+        digest.update(f'{key}\0{listing[key]["ETag"]}\0'.encode())
+    # the page refers to assets by their hashed names, so it must be rendered again when an asset changes
+    for name in sorted(assets or {}):
+        digest.update(f'{name}\0{assets[name]}\0'.encode())
+    # switching between a single page and per-letter pages must publish the other layout
+    if sharded:
+        digest.update(b'sharded\0')
+    # a deploy that changes the templates or the rendering code must publish the pages again
+    digest.update(f'render\0{render_version}\0'.encode())
+    return digest.hexdigest()
+
+
+def create_client_config(max_workers: int = DEFAULT_MAX_WORKERS) -> Config:
+    return Config(
+        # one pooled connection per worker, so concurrent requests never wait for a connection
+        max_pool_connections=max(max_workers, DEFAULT_MAX_WORKERS),
+        connect_timeout=10,
+        read_timeout=30,
+        retries={'max_attempts': 5}
+    )
+
+
+# Owns the one S3 client used by every phase of a publish run (list, fetch, copy, upload and delete),
+# so that they all share a connection pool and reuse its kept-alive connections.
+class Publisher:
+    def __init__(self, session: Session, max_workers: int = DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.client = session.client('s3', config=create_client_config(max_workers))
+
+    def get_listing(self, bucket: str) -> Dict[str, Dict[str, Any]]:
+        return get_listing(self.client, bucket)
+
+    def get_published_objects(self, bucket: str, prefix: str = '') -> Dict[str, Dict[str, Any]]:
+        return get_published_objects(self.client, bucket, prefix)
+
+    def generate_entries(self, bucket: str, listing: Dict[str, Dict[str, Any]],
+                         cache: Optional[FingerprintCache] = None) -> Iterator[Entry]:
+        return generate_entries(self.client, bucket, listing, self.max_workers, cache)
+
+    def iter_all_entries(self, bucket: str, cache: Optional[FingerprintCache] = None) -> Iterator[Entry]:
+        return iter_all_entries(self.client, bucket, self.max_workers, cache)
+
+    def fetch_public_keys(self, bucket: str, keys: List[str], listing: Dict[str, Dict[str, Any]],
+                          cache: Optional[FingerprintCache] = None) -> Dict[str, Optional[str]]:
+        return fetch_public_keys(self.client, bucket, keys, listing, self.max_workers, cache)
+
+    def copy_keys(self, source_bucket: str, dest_bucket: str, entries: List[Entry]) -> Dict[str, Optional[str]]:
+        return copy_keys_to_public_bucket(self.client, source_bucket, dest_bucket, entries, self.max_workers)
+
+    def delete_keys(self, bucket: str, keys: List[str], dry_run: bool = False) -> Dict[str, str]:
+        return delete_keys(self.client, bucket, keys, dry_run)
+
+    def upload_files(self, bucket: str, path: str, prefix: str = '',
+                     published: Optional[Dict[str, Dict[str, Any]]] = None) -> List[str]:
+        return upload_files(self.client, bucket, path, prefix, published)
+
+    def publish_static_assets(self, bucket: str, path: str, prefix: str = '',
+                              published: Optional[Dict[str, Dict[str, Any]]] = None) -> Dict[str, str]:
+        return publish_static_assets(self.client, bucket, path, prefix, published)
+
+    def upload_html(self, bucket: str, key: str, body: str, published: Optional[Dict[str, Dict[str, Any]]] = None,
+                    compress: bool = False, cache_control: Optional[str] = None) -> bool:
+        return upload_html(self.client, bucket, key, body, published, compress, cache_control)
+
+    def upload_document(self, bucket: str, key: str, body: bytes, content_type: str,
+                        published: Optional[Dict[str, Dict[str, Any]]] = None, compress: bool = False,
+                        cache_control: Optional[str] = None) -> bool:
+        return upload_document(self.client, bucket, key, body, content_type, published, compress, cache_control)
+
+    def load_manifest(self, bucket: str) -> Dict[str, Dict[str, Any]]:
+        return load_manifest(self.client, bucket)
+
+    def save_manifest(self, bucket: str, manifest: Dict[str, Dict[str, Any]]) -> None:
+        save_manifest(self.client, bucket, manifest)
 
 
 if __name__ == "__main__":
@@ -1,19 +1,11 @@
 import os
 import shutil
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-
-
-THIS_DIR = os.path.dirname(os.path.abspath(__file__))
-env = Environment(
-    loader=FileSystemLoader(THIS_DIR + '/templates/public'),
-    trim_blocks=True,
-    autoescape=select_autoescape(['html', 'xml'])
-)
+import template_env
 
 
 def render_page(securedrop_url: str, path: str, passes_healthcheck: bool):
-    root_template = env.get_template('securedrop.html')
+    root_template = template_env.get_template('securedrop.html')
     return root_template.render(
         securedrop_url=securedrop_url,
         path=path,
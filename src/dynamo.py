@@ -1,11 +1,26 @@
 import decimal
 import json
+import logging
 import numbers
 import time
 from collections.abc import Iterable, Mapping, ByteString, Set
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
-from boto3.dynamodb.conditions import Attr
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger('securecontact.dynamo')
+
+# the key schema of the MonitorTargetHistory table
+HISTORY_KEYS = ['Target', 'CheckTime']
+# batch_write_item accepts at most 25 items per request
+BATCH_SIZE = 25
+# buffered items are sent once the oldest has waited this many seconds, even if the batch is not full
+MAX_BUFFER_AGE = 5
+# initial delay, factor and maximum delay in seconds when DynamoDB throttles a batch
+RETRY_BACKOFF = (0.05, 2, 5)
+MAX_RETRIES = 10
+THROTTLING_ERRORS = {'ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded'}
 
 
 # Helper class to convert a DynamoDB item to JSON.
@@ -20,12 +35,14 @@ class DecimalEncoder(json.JSONEncoder):
 # objects are used to be able to round-trip the Python type...
 # We are using a lightweight serializer from author of Bloop:
 # https://github.com/boto/boto3/issues/369#issuecomment-330136042
-def dump_to_dynamodb(item):
-    context = decimal.Context(
-        Emin=-128, Emax=126, rounding=None, prec=38,
-        traps=[decimal.Clamped, decimal.Overflow, decimal.Underflow]
-    )
+# The context is shared rather than built again for every value in the item.
+DYNAMODB_CONTEXT = decimal.Context(
+    Emin=-128, Emax=126, rounding=None, prec=38,
+    traps=[decimal.Clamped, decimal.Overflow, decimal.Underflow]
+)
+
 
+def dump_to_dynamodb(item):
     # don't catch str/bytes with Iterable check below;
     # don't catch bool with numbers.Number
     if isinstance(item, (str, ByteString, bool)):
@@ -33,7 +50,7 @@ def dump_to_dynamodb(item):
 
     # ignore inexact, rounding errors
     if isinstance(item, numbers.Number):
-        return context.create_decimal(item)
+        return DYNAMODB_CONTEXT.create_decimal(item)
 
     elif isinstance(item, Dict):
         for key, value in item.items():
@@ -44,7 +61,7 @@ def dump_to_dynamodb(item):
     elif isinstance(item, Mapping):
         return {
             key: dump_to_dynamodb(value)
-            for key, value in item.values()
+            for key, value in item.items()
         }
 
     # dynamodb.TypeSerializer checks isinstance(o, Set)
@@ -67,14 +84,110 @@ def write_to_database(dynamodb, table_name: str, item: Dict[str, str]):
     monitor_table.put_item(Item=dump_to_dynamodb(item))
 
 
-def read_from_database(dynamodb, table_name: str) -> List[Dict[str, str]]:
+# Buffers items for any number of tables and writes them with batch_write_item, reusing one Table handle per table.
+# A table's items are sent once a full batch is buffered or its oldest item is MAX_BUFFER_AGE seconds old,
+# which is checked as items are added, and whatever is left is sent when the buffer is flushed or closed.
+# Unprocessed items and throttled batches are retried with backoff, and stay buffered if they are given up on.
+class WriteBuffer:
+    def __init__(self, dynamodb, flush_amount: int = BATCH_SIZE, max_age: float = MAX_BUFFER_AGE,
+                 overwrite_by_pkeys: Optional[List[str]] = None,
+                 backoff: Tuple[float, float, float] = RETRY_BACKOFF, max_retries: int = MAX_RETRIES):
+        self._dynamodb = dynamodb
+        self._flush_amount = min(flush_amount, BATCH_SIZE)
+        self._max_age = max_age
+        self._overwrite_by_pkeys = overwrite_by_pkeys
+        self._backoff = backoff
+        self._max_retries = max_retries
+        self._tables = {}
+        self._buffers: Dict[str, List[Dict]] = {}
+        self._oldest: Dict[str, float] = {}
+
+    def table(self, table_name: str):
+        if table_name not in self._tables:
+            self._tables[table_name] = self._dynamodb.Table(table_name)
+        return self._tables[table_name]
+
+    def put(self, table_name: str, item: Dict[str, str]) -> None:
+        item = dump_to_dynamodb(item)
+        buffer = self._buffers.setdefault(table_name, [])
+        if not buffer:
+            self._oldest[table_name] = time.monotonic()
+        # a batch may not hold two requests for the same key, so a newer item replaces the buffered one
+        if self._overwrite_by_pkeys:
+            key = [item.get(name) for name in self._overwrite_by_pkeys]
+            buffer[:] = [request for request in buffer
+                         if [request['PutRequest']['Item'].get(name) for name in self._overwrite_by_pkeys] != key]
+        buffer.append({'PutRequest': {'Item': item}})
+        if len(buffer) >= self._flush_amount or time.monotonic() - self._oldest[table_name] >= self._max_age:
+            self._write_batch(table_name)
+
+    def flush(self) -> None:
+        for table_name, buffer in self._buffers.items():
+            while buffer:
+                self._write_batch(table_name)
+
+    def _write_batch(self, table_name: str) -> None:
+        buffer = self._buffers[table_name]
+        batch = buffer[:self._flush_amount]
+        del buffer[:len(batch)]
+        client = self.table(table_name).meta.client
+        retries = 0
+        while batch:
+            try:
+                response = client.batch_write_item(RequestItems={table_name: batch})
+                unprocessed = (response.get('UnprocessedItems') or {}).get(table_name, [])
+                reason = f'{len(unprocessed)} unprocessed items'
+            except ClientError as err:
+                if err.response['Error']['Code'] not in THROTTLING_ERRORS:
+                    buffer[:0] = batch
+                    raise
+                unprocessed, reason = batch, err
+            if unprocessed and retries >= self._max_retries:
+                buffer[:0] = unprocessed
+                raise RuntimeError(f'{table_name}: gave up writing {len(unprocessed)} items '
+                                   f'after {retries} retries ({reason})')
+            if unprocessed:
+                initial, factor, maximum = self._backoff
+                delay = min(initial * factor ** retries, maximum)
+                logger.warning(f'{table_name}: {reason}, retrying in {delay:.2f} seconds')
+                retries += 1
+                time.sleep(delay)
+            batch = unprocessed
+        if buffer:
+            self._oldest[table_name] = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
+
+
+def write_items_to_database(dynamodb, table_name: str, items: List[Dict[str, str]]):
+    # items for the same target and check time would be rejected in one batch, so the last one wins
+    with WriteBuffer(dynamodb, overwrite_by_pkeys=HISTORY_KEYS) as buffer:
+        for item in items:
+            buffer.put(table_name, item)
+
+
+# The history table is keyed by Target with CheckTime as the sort key,
+# so reads are queries against a single target rather than scans of the whole table.
+def read_from_database(dynamodb, table_name: str, target: str, period: int = 6000) -> List[Dict[str, str]]:
     table = dynamodb.Table(table_name)
     current_time = int(time.time())
-    cutoff_time = current_time - 6000
-    filter_expression = Attr('CheckTime').between(cutoff_time, current_time)
+    key_condition = Key('Target').eq(target) & Key('CheckTime').between(current_time - period, current_time)
 
-    response = table.scan(
-        FilterExpression=filter_expression,
-        Limit=10
-    )
+    response = table.query(KeyConditionExpression=key_condition, ScanIndexForward=False)
     return response['Items']
+
+
+# The newest check for the target, read with a single item query however long the history is
+def read_latest_check(dynamodb, table_name: str, target: str) -> Optional[Dict[str, str]]:
+    table = dynamodb.Table(table_name)
+    response = table.query(
+        KeyConditionExpression=Key('Target').eq(target),
+        ScanIndexForward=False,
+        Limit=1
+    )
+    items = response['Items']
+    return items[0] if items else None
@@ -1,16 +1,23 @@
 import os
 import time
+import fcntl
+import hashlib
+import asyncio
 import logging
 
-from typing import Optional, Union, Dict, List
+from contextlib import contextmanager
+from typing import Iterator, NamedTuple, Optional, Union, Dict, List, Tuple
 
 import requests
 from boto3 import Session
+from botocore.exceptions import BotoCoreError, ClientError
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from urllib3.exceptions import HTTPError as Urllib3Error
 
 from src.notifications import create_email, send_message, send_email
 from securedrop import build_pages
-from src.dynamo import read_from_database, write_to_database
+from src.dynamo import read_latest_check, write_items_to_database, write_to_database
 
 
 logging.basicConfig(level=logging.INFO,
@@ -53,22 +60,141 @@ def fetch_parameter(client, name: str) -> Union[str, None]:
         return None
 
 
-# N.B. this script requires Tor to be running on the server
-def send_request(onion_address: str) -> Optional[requests.Response]:
-    # TODO: handle any ConnectionRefusedError and ConnectTimeoutError
-    target = f'http://{onion_address}'
-    headers = {
-        'User-agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0',
-        'referer': 'https://www.google.com'
-    }
-    proxies = {
-        'http': 'socks5h://127.0.0.1:9050',
-        'https': 'socks5h://127.0.0.1:9050'
-    }
+TOR_PROXY = 'socks5h://127.0.0.1:9050'
+
+# Each attempt must finish within ATTEMPT_DEADLINE seconds. Failed attempts are retried after BACKOFF_INITIAL
+# seconds, multiplied by BACKOFF_FACTOR after every attempt up to BACKOFF_MAX, which waits 130 seconds in total
+# between five attempts rather than the four minutes of fixed 60 second sleeps.
+HEALTHCHECK_ATTEMPTS = 5
+ATTEMPT_DEADLINE = 30
+BACKOFF_INITIAL = 10
+BACKOFF_FACTOR = 2
+BACKOFF_MAX = 60
+
+# Tor puts streams with different SOCKS credentials on different circuits (IsolateSOCKSAuth is on by default).
+# 'target' gives every target its own circuit, reused between attempts, 'attempt' builds a fresh circuit for every
+# attempt so that one bad circuit cannot fail a target twice, and 'none' lets the targets share circuits.
+STREAM_ISOLATION = 'target'
+
+# Optionally make one request to each target before the attempts, and without counting it, so that the circuit
+# and connection are already built and the attempts time the site rather than Tor. It has no effect with 'attempt'
+# isolation, where every attempt gets a circuit of its own.
+PREWARM_CIRCUITS = False
+
+HEADERS = {
+    'User-agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0',
+    'referer': 'https://www.google.com'
+}
+
+# at most this many targets are requested at once over the shared Tor proxy
+MONITOR_CONCURRENCY = 4
+
+# cron starts a run every 20 minutes, so a lock stops a slow run from overlapping with the next one.
+# It lives in the app directory rather than /tmp because the first run at boot is made as root before
+# the directory is handed over to www-data, who makes every run after that.
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOCK_FILE = os.getenv('MONITOR_LOCK_FILE', os.path.join(APP_DIR, 'monitor.lock'))
+
+
+# The seconds spent connecting, which is 0 when a kept-alive connection was reused, then waiting for the
+# response headers, and on the whole attempt; None for a phase that was never completed.
+class Timings(NamedTuple):
+    connect: Optional[float]
+    first_byte: Optional[float]
+    total: float
+
+
+class CheckResult(NamedTuple):
+    passed: bool
+    attempts: int
+    timings: List[Timings]
+
+
+def stream_proxy(proxy: Optional[str], isolation: str, onion_address: str, attempt: int) -> Optional[str]:
+    if not proxy or isolation == 'none':
+        return proxy
+    stream = onion_address if isolation == 'target' else f'{onion_address}/{attempt}'
+    scheme, address = proxy.split('://', 1)
+    return f'{scheme}://{hashlib.sha256(stream.encode()).hexdigest()[:16]}:isolate@{address}'
+
+
+# Records how long each new connection took to open. For an onion service this covers the SOCKS negotiation,
+# building the circuit and the rendezvous, so a slow Tor network can be told apart from a slow site.
+# The pools that requests creates, directly or through a proxy, are given a connection class that times connect().
+class TimedAdapter(HTTPAdapter):
+    def __init__(self, *args, **kwargs):
+        self.connect_times: List[float] = []
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.time_connections(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        self.time_connections(manager)
+        return manager
+
+    def time_connections(self, manager) -> None:
+        if getattr(manager, 'connections_timed', False):
+            return
+        manager.pool_classes_by_scheme = {scheme: self.timed_pool(pool_cls)
+                                          for scheme, pool_cls in manager.pool_classes_by_scheme.items()}
+        manager.connections_timed = True
+
+    def timed_pool(self, pool_cls):
+        connect_times = self.connect_times
+
+        class TimedConnection(pool_cls.ConnectionCls):
+            def connect(self):
+                start = time.perf_counter()
+                super().connect()
+                connect_times.append(time.perf_counter() - start)
+
+        return type(pool_cls.__name__, (pool_cls,), {'ConnectionCls': TimedConnection})
+
+
+# One session per target keeps the connection, and with it the Tor circuit, alive between attempts
+def create_http_session() -> requests.Session:
+    session = requests.Session()
+    session.mount('http://', TimedAdapter())
+    session.mount('https://', TimedAdapter())
+    session.headers.update(HEADERS)
+    # the proxy is always chosen explicitly, never from the environment
+    session.trust_env = False
+    return session
+
+
+# Half of the deadline is allowed for connecting and half for each read, so that the request gives up
+# at about the deadline by itself; the onion page is small enough to arrive in a few reads.
+def timed_request(session: requests.Session, onion_address: str, proxy: Optional[str],
+                  deadline: float) -> Tuple[Optional[requests.Response], Timings]:
+    url = f'http://{onion_address}'
+    proxies = {'http': proxy, 'https': proxy} if proxy else {}
+    adapter = session.get_adapter(url)
+    connect_times = getattr(adapter, 'connect_times', [])
+    connect_times.clear()
+    connect = first_byte = None
+    start = time.perf_counter()
     try:
-        return requests.get(target, headers=headers, proxies=proxies, timeout=10)
-    except RequestException as err:
+        response = session.get(url, proxies=proxies, timeout=(deadline / 2, deadline / 2), stream=True)
+        # elapsed runs from sending the request to parsing the headers, including any time spent connecting
+        connect = sum(connect_times)
+        first_byte = max(response.elapsed.total_seconds() - connect, 0)
+        response.content
+    except (RequestException, Urllib3Error, OSError) as err:
         logger.error(err)
+        response = None
+        connect = sum(connect_times) if connect_times else None
+    return response, Timings(connect, first_byte, time.perf_counter() - start)
+
+
+# N.B. this script requires Tor to be running on the server
+def send_request(onion_address: str, proxy: Optional[str] = TOR_PROXY,
+                 timeout: float = 10) -> Optional[requests.Response]:
+    # keeps timeout as the limit for connecting and for each read, as before attempts had a deadline
+    with create_http_session() as session:
+        return timed_request(session, onion_address, proxy, 2 * timeout)[0]
 
 
 def healthcheck(response: Optional[requests.Response]) -> bool:
@@ -85,13 +211,32 @@ def get_expiry(current_time: int) -> int:
     return current_time + 604800
 
 
-def create_item(current_time: int, outcome: bool) -> Dict[str, str]:
+def create_item(current_time: int, outcome: bool, target: Optional[str] = None,
+                timings: Optional[List[Timings]] = None) -> Dict[str, str]:
     expiration = get_expiry(current_time)
-    return {
+    item = {
         'CheckTime': current_time,
         'ExpirationTime': expiration,
         'Outcome': str(outcome)
     }
+    if target is not None:
+        item['Target'] = target
+    if timings is not None:
+        item['Attempts'] = [
+            {key: None if value is None else round(value, 3) for key, value in zip(
+                ('Connect', 'FirstByte', 'Total'), attempt)}
+            for attempt in timings
+        ]
+    return item
+
+
+# the SecureDrop site comes first, followed by any mirrors from the comma separated MONITOR_TARGETS
+def get_targets(config: Dict[str, str]) -> List[str]:
+    targets = [config['SECUREDROP_URL']]
+    for target in (config.get('MONITOR_TARGETS') or '').split(','):
+        if target.strip() and target.strip() not in targets:
+            targets.append(target.strip())
+    return targets
 
 
 def upload_website_index(session: Session, config: Dict[str, str], passes_healthcheck: bool) -> None:
@@ -120,22 +265,25 @@ def send_failure_email(session: Session, config: Dict[str, str]):
     send_email(session, config, create_email(subject, heading, message))
 
 
-def state_has_changed(healthy: bool, history: List[Dict[str, str]]) -> bool:
-    # TODO: compare result of latest check with previous record
-    pass
+# compares the latest check with the previous record for the same target;
+# without any history, the first check counts as a change so that the page and alerts are published
+def state_has_changed(healthy: bool, previous: Optional[Dict[str, str]]) -> bool:
+    if previous is None:
+        return True
+    return previous.get('Outcome') != str(healthy)
 
 
 def monitor(session: Session, config: Dict[str, str], stage: str):
     dynamodb = create_service_resource(session, stage)
     response = send_request(config['SECUREDROP_URL'])
-    history = read_from_database(dynamodb, config['TABLE_NAME'])
+    previous = read_latest_check(dynamodb, config['TABLE_NAME'], config['SECUREDROP_URL'])
     healthy = healthcheck(response)
 
     logger.info(f'Healthcheck outcome: {healthy}')
-    logger.debug(history)
+    logger.debug(previous)
 
     # TODO: perform update once per day regardless and give MOTD
-    if state_has_changed(healthy, history):
+    if state_has_changed(healthy, previous):
         upload_website_index(session, config, healthy)
         send_message(config, healthy)
         # we also send an email alert
@@ -143,28 +291,163 @@ def monitor(session: Session, config: Dict[str, str], stage: str):
             send_failure_email(session, config)
 
     # Finally, update the database with the latest result
-    item = create_item(int(time.time()), healthy)
+    item = create_item(int(time.time()), healthy, config['SECUREDROP_URL'])
     write_to_database(dynamodb, config['TABLE_NAME'], item)
 
 
-def run(session: Session, config: Dict[str, str]):
-    attempts = 0
-    while attempts < 5:
-        attempts += 1
-        response = send_request(config['SECUREDROP_URL'])
-        passes_healthcheck = healthcheck(response)
-        if passes_healthcheck:
-            logger.info(f'Healthcheck: passed on attempt {attempts}')
-            upload_website_index(session, config, passes_healthcheck)
+def backoff_delay(attempt: int, initial: float = BACKOFF_INITIAL, factor: float = BACKOFF_FACTOR,
+                  maximum: float = BACKOFF_MAX) -> float:
+    return min(initial * factor ** (attempt - 1), maximum)
+
+
+def format_timings(timings: Timings) -> str:
+    connect, first_byte, total = ('-' if value is None else f'{value:.2f}s' for value in timings)
+    return f'connect {connect}, first byte {first_byte}, total {total}'
+
+
+# requests blocks, so each attempt runs in the default executor and is abandoned once its deadline passes.
+# The deadline is cooperative: an abandoned request cannot be cancelled, and carries on until its own timeouts
+# end it shortly afterwards. The limit is only held while a request is in flight, so targets that are
+# backing off do not hold up the others.
+async def attempt_healthcheck(session: requests.Session, onion_address: str, deadline: float, proxy: Optional[str],
+                              limit: Optional[asyncio.Semaphore] = None) -> Tuple[bool, Timings]:
+    if limit is None:
+        limit = asyncio.Semaphore(1)
+    async with limit:
+        loop = asyncio.get_event_loop()
+        request = loop.run_in_executor(None, timed_request, session, onion_address, proxy, deadline)
+        try:
+            response, timings = await asyncio.wait_for(request, deadline)
+        except asyncio.TimeoutError:
+            logger.error(f'Healthcheck: no response from {onion_address} within {deadline} seconds')
+            return False, Timings(None, None, deadline)
+    return healthcheck(response), timings
+
+
+# returns whether the site passed, on which attempt and the timings of every attempt,
+# as soon as it passes or runs out of attempts
+async def check_site(onion_address: str, attempts: int = HEALTHCHECK_ATTEMPTS, deadline: float = ATTEMPT_DEADLINE,
+                     backoff: Tuple[float, float, float] = (BACKOFF_INITIAL, BACKOFF_FACTOR, BACKOFF_MAX),
+                     proxy: Optional[str] = TOR_PROXY, limit: Optional[asyncio.Semaphore] = None,
+                     isolation: str = STREAM_ISOLATION, prewarm: bool = PREWARM_CIRCUITS) -> CheckResult:
+    timings = []
+    session = create_http_session()
+    try:
+        if prewarm and isolation != 'attempt':
+            warm_proxy = stream_proxy(proxy, isolation, onion_address, 0)
+            _, warm_timings = await attempt_healthcheck(session, onion_address, deadline, warm_proxy, limit)
+            logger.info(f'Healthcheck: warmed up {onion_address} ({format_timings(warm_timings)})')
+            if warm_timings.first_byte is None:
+                session.close()
+                session = create_http_session()
+        for attempt in range(1, attempts + 1):
+            attempt_proxy = stream_proxy(proxy, isolation, onion_address, attempt)
+            passed, attempt_timings = await attempt_healthcheck(session, onion_address, deadline, attempt_proxy, limit)
+            timings.append(attempt_timings)
+            if passed:
+                logger.info(f'Healthcheck: {onion_address} passed on attempt {attempt} '
+                            f'({format_timings(attempt_timings)})')
+                return CheckResult(True, attempt, timings)
+            logger.info(f'Healthcheck: unable to reach {onion_address} on attempt {attempt} '
+                        f'({format_timings(attempt_timings)})')
+            if attempt_timings.first_byte is None:
+                # an abandoned request may still be using the session, and one that failed to connect
+                # has no connection worth keeping, so the next attempt starts afresh
+                session.close()
+                session = create_http_session()
+            if attempt < attempts:
+                await asyncio.sleep(backoff_delay(attempt, *backoff))
+    finally:
+        session.close()
+    logger.info(f'Healthcheck: {onion_address} failed healthcheck')
+    return CheckResult(False, attempts, timings)
+
+
+# checks every target at the same time, so adding targets does not add to the length of a run
+async def check_sites(targets: List[str], concurrency: int = MONITOR_CONCURRENCY,
+                      **kwargs) -> Dict[str, CheckResult]:
+    limit = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*(check_site(target, limit=limit, **kwargs) for target in targets))
+    return dict(zip(targets, results))
+
+
+# The monitor box runs the system python3, which is 3.6 on Ubuntu 18.04 and has no asyncio.run
+def run_until_complete(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+# yields whether the lock was acquired; the lock is released when the process exits, even if it crashes
+@contextmanager
+def monitor_lock(path: str = LOCK_FILE) -> Iterator[bool]:
+    try:
+        fobj = open(path, 'a')
+    except OSError as err:
+        logger.error(f'Healthcheck: cannot open the lock file {path}: {err}')
+        yield False
+        return
+    with fobj:
+        try:
+            fcntl.flock(fobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.warning('Healthcheck: a previous run is still in progress')
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fobj, fcntl.LOCK_UN)
+
+
+# The status page and alerts follow the SecureDrop site; mirrors only alert when they fail.
+# With a DynamoDB resource, the outcome for every target is recorded in the history table
+# and alerts are only sent when a target's outcome differs from its previous check.
+# The status page is uploaded on every run, so it corrects itself if an upload was missed.
+def run(session: Session, config: Dict[str, str], dynamodb=None):
+    with monitor_lock(LOCK_FILE) as acquired:
+        if not acquired:
+            logger.warning('Healthcheck: could not take the run lock, skipping this run')
+            return
+        targets = get_targets(config)
+        proxy = config.get('TOR_PROXY', TOR_PROXY)
+        isolation = config.get('STREAM_ISOLATION', STREAM_ISOLATION)
+        prewarm = str(config.get('PREWARM_CIRCUITS', PREWARM_CIRCUITS)).lower() == 'true'
+        results = run_until_complete(check_sites(targets, proxy=proxy, isolation=isolation, prewarm=prewarm))
+
+        # the status page must not depend on the history table, so a target whose history cannot be read
+        # is treated as having none, which alerts rather than staying quiet
+        previous = {target: None for target in targets}
+        if dynamodb is not None:
+            for target in targets:
+                try:
+                    previous[target] = read_latest_check(dynamodb, config['TABLE_NAME'], target)
+                except (ClientError, BotoCoreError) as err:
+                    logger.error(f'Healthcheck: cannot read the history of {target}: {err}')
+        changed = {target: state_has_changed(results[target].passed, previous[target]) for target in targets}
+
+        passes_healthcheck = results[config['SECUREDROP_URL']].passed
+        upload_website_index(session, config, passes_healthcheck)
+        if changed[config['SECUREDROP_URL']]:
             send_message(config, passes_healthcheck)
-            break
-        logger.info(f'Healthcheck: unable to reach site on attempt {attempts}')
-        time.sleep(60)
-    else:
-        logger.info('Healthcheck: failed healthcheck')
-        upload_website_index(session, config, False)
-        send_message(config, passed=False)
-        send_failure_email(session, config)
+            if not passes_healthcheck:
+                send_failure_email(session, config)
+        # a mirror with no history only alerts when it fails, but one that recovers is reported too
+        for target in targets[1:]:
+            passed = results[target].passed
+            if changed[target] and not (passed and previous[target] is None):
+                send_message(config, passed, target)
+
+        if dynamodb is not None:
+            current_time = int(time.time())
+            items = [create_item(current_time, result.passed, target, result.timings)
+                     for target, result in results.items()]
+            try:
+                write_items_to_database(dynamodb, config['TABLE_NAME'], items)
+            except (ClientError, BotoCoreError, RuntimeError) as err:
+                logger.error(f'Healthcheck: cannot record the outcome: {err}')
 
 
 if __name__ == '__main__':
@@ -182,9 +465,10 @@ if __name__ == '__main__':
         'PRODMON_SENDER': fetch_parameter(SSM_CLIENT, f'/secure-contact/{STAGE}/prodmon-sender'),
         'PRODMON_RECIPIENT': fetch_parameter(SSM_CLIENT, f'/secure-contact/{STAGE}/prodmon-recipient'),
         'SECUREDROP_URL': fetch_parameter(SSM_CLIENT, "securedrop-url"),
-        'TABLE_NAME': f'MonitorHistory-{STAGE}'
+        'MONITOR_TARGETS': fetch_parameter(SSM_CLIENT, f'/secure-contact/{STAGE}/monitor-targets'),
+        'TABLE_NAME': f'MonitorTargetHistory-{STAGE}'
     }
 
     if CONFIG['BUCKET_NAME'] is not None:
         build_pages(CONFIG['SECUREDROP_URL'], STAGE)
-        run(SESSION, CONFIG)
+        run(SESSION, CONFIG, create_service_resource(SESSION, STAGE))
@@ -1,6 +1,6 @@
 import json
 import logging.handlers
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import requests
 from boto3 import Session
@@ -92,10 +92,12 @@ def generate_message(card_title: str, card_subtitle: str, message_text: str) ->
     }
 
 
-def send_message(config: Dict[str, str], passed: bool):
+def send_message(config: Dict[str, str], passed: bool, target: Optional[str] = None):
     # TODO: message @all to notify when healthcheck fails
     headers = {'Content-Type': 'application/json; charset=UTF-8'}
     status = 'Status: 💚💚💚' if passed else 'Status: 💔💔💔'
+    if target is not None:
+        status = f'{status} {target}'
     message_text = '' if passed else '*Attention <users/all> Healthcheck has failed*'
     message_data = json.dumps(generate_message('SecureDrop Monitor', status, message_text))
 
@@ -0,0 +1,52 @@
+import os
+import sys
+
+from functools import lru_cache
+from typing import Dict, Optional
+
+from jinja2 import Environment, FileSystemLoader, ModuleLoader, Template, select_autoescape
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(THIS_DIR, 'templates', 'public')
+# build-lambda.sh compiles the templates into Python modules here in the Lambda bundle, so they are never parsed at runtime
+COMPILED_DIR = os.path.join(THIS_DIR, 'compiled_templates')
+
+# compiled templates bake in these options, so both environments must use the same ones
+ENVIRONMENT_OPTIONS = {
+    'trim_blocks': True,
+    'autoescape': select_autoescape(['html', 'xml'])
+}
+
+
+# pages published with hashed asset names pass a mapping from each file to its published name
+def static_path(path: str, name: str, assets: Optional[Dict[str, str]] = None) -> str:
+    return f'{path}static/{(assets or {}).get(name, name)}'
+
+
+def create_environment(compiled_dir: str = COMPILED_DIR) -> Environment:
+    if os.path.isdir(compiled_dir):
+        # compiled templates cannot change underneath us, so skip the stat check on every get_template
+        environment = Environment(loader=ModuleLoader(compiled_dir), auto_reload=False, **ENVIRONMENT_OPTIONS)
+    else:
+        environment = Environment(loader=FileSystemLoader(TEMPLATE_DIR), **ENVIRONMENT_OPTIONS)
+    environment.globals['static_path'] = static_path
+    return environment
+
+
+env = create_environment()
+
+
+@lru_cache(maxsize=None)
+def get_template(name: str) -> Template:
+    return env.get_template(name)
+
+
+def compile_templates(target: str = COMPILED_DIR) -> None:
+    source_env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), **ENVIRONMENT_OPTIONS)
+    source_env.compile_templates(target, zip=None, ignore_errors=False)
+
+
+if __name__ == '__main__':
+    target_dir = sys.argv[1] if len(sys.argv) > 1 else COMPILED_DIR
+    compile_templates(target_dir)
+    print(f'Compiled templates into {target_dir}')
@@ -1,12 +1,21 @@
+import decimal
 import unittest
 import boto3
 import time
 
-from src.monitor import create_item
-from src.dynamo import write_to_database, read_from_database
+from types import SimpleNamespace
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from src.monitor import Timings, create_item
+from src.dynamo import *
 
 # !! ~~ Only use this module for local testing ~~ !!
 
+TARGET = 'securedrop.onion'
+MIRROR = 'mirror.onion'
+
 
 # Use the provided CloudFormation template to create the table in AWS environments.
 # If you update this then be sure to also update the CloudFormation definition.
@@ -16,22 +25,22 @@ def create_table(client, table_name: str):
             TableName=table_name,
             KeySchema=[
                 {
-                    'AttributeName': 'CheckTime',
+                    'AttributeName': 'Target',
                     'KeyType': 'HASH'
                 },
                 {
-                    'AttributeName': 'Outcome',
+                    'AttributeName': 'CheckTime',
                     'KeyType': 'RANGE'
                 }
             ],
             AttributeDefinitions=[
                 {
-                    'AttributeName': 'CheckTime',
-                    'AttributeType': 'N'
+                    'AttributeName': 'Target',
+                    'AttributeType': 'S'
                 },
                 {
-                    'AttributeName': 'Outcome',
-                    'AttributeType': 'S'
+                    'AttributeName': 'CheckTime',
+                    'AttributeType': 'N'
                 }
             ],
             ProvisionedThroughput={
@@ -72,12 +81,138 @@ def get_table_status(dynamodb, table_name: str):
 def create_records(dynamodb, table_name: str):
     current_time = int(time.time())
     monitor_table = dynamodb.Table(table_name)
-    monitor_table.put_item(Item=create_item(current_time - 9100, True))
-    monitor_table.put_item(Item=create_item(current_time - 6100, True))
-    monitor_table.put_item(Item=create_item(current_time - 3100, True))
-    monitor_table.put_item(Item=create_item(current_time - 900, True))
-    monitor_table.put_item(Item=create_item(current_time - 600, True))
-    monitor_table.put_item(Item=create_item(current_time - 300, True))
+    monitor_table.put_item(Item=create_item(current_time - 9100, True, TARGET))
+    monitor_table.put_item(Item=create_item(current_time - 6100, True, TARGET))
+    monitor_table.put_item(Item=create_item(current_time - 3100, True, TARGET))
+    monitor_table.put_item(Item=create_item(current_time - 900, True, TARGET))
+    monitor_table.put_item(Item=create_item(current_time - 600, True, TARGET))
+    monitor_table.put_item(Item=create_item(current_time - 300, False, TARGET))
+    monitor_table.put_item(Item=create_item(current_time - 60, True, MIRROR))
+
+
+# Records batch_write_item requests; each entry in `responses` is either an error to raise
+# or the number of items from the end of the batch to return as unprocessed.
+class FakeClient:
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.batches = []
+        self.written = []
+
+    def batch_write_item(self, RequestItems):
+        (table_name, requests), = RequestItems.items()
+        self.batches.append(len(requests))
+        response = self.responses.pop(0) if self.responses else 0
+        if isinstance(response, Exception):
+            raise response
+        unprocessed = requests[len(requests) - response:] if response else []
+        self.written.extend(request['PutRequest']['Item'] for request in requests[:len(requests) - response])
+        return {'UnprocessedItems': {table_name: unprocessed} if unprocessed else {}}
+
+
+class FakeDynamoDB:
+    def __init__(self, responses=()):
+        self.client = FakeClient(responses)
+        self.tables = []
+
+    def Table(self, table_name):
+        self.tables.append(table_name)
+        return SimpleNamespace(name=table_name, meta=SimpleNamespace(client=self.client))
+
+
+def throttled():
+    return ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'BatchWriteItem')
+
+
+class TestWriteBuffer(unittest.TestCase):
+    def setUp(self) -> None:
+        patch = mock.patch('src.dynamo.time.sleep')
+        self.sleep = patch.start()
+        self.addCleanup(patch.stop)
+
+    def items(self, count):
+        return [create_item(1570701600 + i, True, TARGET) for i in range(count)]
+
+    def test_flushes_full_batches(self):
+        dynamodb = FakeDynamoDB()
+        with WriteBuffer(dynamodb) as buffer:
+            for item in self.items(30):
+                buffer.put('MonitorTargetHistory-DEV', item)
+            self.assertEqual([25], dynamodb.client.batches)
+        self.assertEqual([25, 5], dynamodb.client.batches)
+        self.assertEqual(30, len(dynamodb.client.written))
+
+    def test_flushes_old_items(self):
+        dynamodb = FakeDynamoDB()
+        with WriteBuffer(dynamodb, max_age=0) as buffer:
+            for item in self.items(3):
+                buffer.put('MonitorTargetHistory-DEV', item)
+            self.assertEqual([1, 1, 1], dynamodb.client.batches)
+
+    def test_reuses_table_handles(self):
+        dynamodb = FakeDynamoDB()
+        with WriteBuffer(dynamodb) as buffer:
+            for item in self.items(3):
+                buffer.put('MonitorTargetHistory-DEV', item)
+                buffer.put('MonitorTargetHistory-CODE', item)
+        self.assertEqual(['MonitorTargetHistory-DEV', 'MonitorTargetHistory-CODE'], dynamodb.tables)
+        self.assertEqual([3, 3], dynamodb.client.batches)
+
+    def test_retries_unprocessed_items(self):
+        dynamodb = FakeDynamoDB(responses=[2, 1])
+        with self.assertLogs('securecontact.dynamo', 'WARNING'):
+            write_items_to_database(dynamodb, 'MonitorTargetHistory-DEV', self.items(5))
+        self.assertEqual([5, 2, 1], dynamodb.client.batches)
+        self.assertEqual(list(range(1570701600, 1570701605)),
+                         sorted(item['CheckTime'] for item in dynamodb.client.written))
+        self.assertEqual([mock.call(0.05), mock.call(0.1)], self.sleep.call_args_list)
+
+    def test_keeps_throttled_batches(self):
+        dynamodb = FakeDynamoDB(responses=[throttled(), throttled()])
+        with self.assertLogs('securecontact.dynamo', 'WARNING'):
+            write_items_to_database(dynamodb, 'MonitorTargetHistory-DEV', self.items(5))
+        self.assertEqual([5, 5, 5], dynamodb.client.batches)
+        self.assertEqual(5, len(dynamodb.client.written))
+        self.assertEqual(2, self.sleep.call_count)
+
+    def test_puts_after_a_throttled_batch_are_kept(self):
+        dynamodb = FakeDynamoDB(responses=[throttled()])
+        with self.assertLogs('securecontact.dynamo', 'WARNING'):
+            write_items_to_database(dynamodb, 'MonitorTargetHistory-DEV', self.items(26))
+        self.assertEqual([25, 25, 1], dynamodb.client.batches)
+        self.assertEqual(list(range(1570701600, 1570701626)),
+                         sorted(item['CheckTime'] for item in dynamodb.client.written))
+
+    def test_gives_up_after_max_retries(self):
+        dynamodb = FakeDynamoDB(responses=[throttled()] * 3)
+        buffer = WriteBuffer(dynamodb, max_retries=2)
+        buffer.put('MonitorTargetHistory-DEV', self.items(1)[0])
+        with self.assertLogs('securecontact.dynamo', 'WARNING'), self.assertRaises(RuntimeError):
+            buffer.flush()
+        # the items stay buffered for a later flush
+        buffer.flush()
+        self.assertEqual(1, len(dynamodb.client.written))
+
+    def test_other_errors_are_raised(self):
+        error = ClientError({'Error': {'Code': 'ResourceNotFoundException'}}, 'BatchWriteItem')
+        dynamodb = FakeDynamoDB(responses=[error])
+        with self.assertRaises(ClientError):
+            write_items_to_database(dynamodb, 'MonitorTargetHistory-DEV', self.items(1))
+        self.sleep.assert_not_called()
+
+    def test_items_with_the_same_key_are_overwritten(self):
+        dynamodb = FakeDynamoDB()
+        items = [create_item(1570701600, False, TARGET), create_item(1570701600, True, TARGET)]
+        write_items_to_database(dynamodb, 'MonitorTargetHistory-DEV', items)
+        self.assertEqual(['True'], [item['Outcome'] for item in dynamodb.client.written])
+
+    def test_dump_to_dynamodb(self):
+        item = dump_to_dynamodb(create_item(1570701600, False, TARGET, [Timings(None, None, 30), Timings(2.5, 0.8, 3.4)]))
+        self.assertEqual(decimal.Decimal(1570701600), item['CheckTime'])
+        number = DYNAMODB_CONTEXT.create_decimal
+        self.assertEqual([
+            {'Connect': None, 'FirstByte': None, 'Total': number(30)},
+            {'Connect': number(2.5), 'FirstByte': number(0.8), 'Total': number(3.4)}
+        ], item['Attempts'])
 
 
 # !! ~~ Only use this module for local testing ~~ !!
@@ -85,7 +220,7 @@ def create_records(dynamodb, table_name: str):
 @unittest.skip('these tests are for DEV only and require local dynamodb to be running')
 class TestDatabase(unittest.TestCase):
     def setUp(self) -> None:
-        self.table_name = 'MonitorHistory-DEV'
+        self.table_name = 'MonitorTargetHistory-DEV'
         self.dynamodb = boto3.resource('dynamodb', region_name='eu-west-1', endpoint_url="http://localhost:8000")
         self.client = boto3.client('dynamodb', region_name='eu-west-1', endpoint_url="http://localhost:8000")
 
@@ -103,16 +238,20 @@ class TestDatabase(unittest.TestCase):
         pass
 
     def test_read_and_write(self):
-        first_result = read_from_database(self.dynamodb, self.table_name)
-        self.assertEqual(6, first_result.get('ScannedCount'))
-        self.assertEqual(4, len(first_result.get('Items')))
+        first_result = read_from_database(self.dynamodb, self.table_name, TARGET)
+        self.assertEqual(4, len(first_result))
 
-        new_item = create_item(int(time.time()), True)
+        new_item = create_item(int(time.time()), True, TARGET)
         write_to_database(self.dynamodb, self.table_name, new_item)
 
-        second_result = read_from_database(self.dynamodb, self.table_name)
-        self.assertEqual(7, second_result.get('ScannedCount'))
-        self.assertEqual(5, len(second_result.get('Items')))
+        second_result = read_from_database(self.dynamodb, self.table_name, TARGET)
+        self.assertEqual(5, len(second_result))
+        self.assertEqual(new_item['CheckTime'], second_result[0]['CheckTime'])
+
+    def test_read_latest_check(self):
+        self.assertEqual('False', read_latest_check(self.dynamodb, self.table_name, TARGET)['Outcome'])
+        self.assertEqual('True', read_latest_check(self.dynamodb, self.table_name, MIRROR)['Outcome'])
+        self.assertIsNone(read_latest_check(self.dynamodb, self.table_name, 'unknown.onion'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,70 @@
+import contextlib
+import io
+import os
+import tempfile
+import time
+import unittest
+
+from fingerprint_cache import *
+from pgp_manager import fetch_fingerprint, get_fingerprint_index, generate_entry
+from benchmarks.fake_s3 import FakeS3Client, create_directory
+
+
+class TestFingerprintCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = FingerprintCache(self.directory.name)
+        self.client = FakeS3Client({'data': create_directory(3)})
+        self.name = 'Contact00000 Surname00000'
+        self.key = f'Fingerprints/{self.name}.fpr.txt'
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_put_and_get(self):
+        self.assertIsNone(self.cache.get(self.key))
+        self.cache.put(self.key, '"etag"', 'body')
+        self.assertEqual(('"etag"', 'body'), self.cache.get(self.key))
+
+    def test_matching_etag_is_a_local_hit(self):
+        first = fetch_fingerprint(self.client, 'data', self.name, self.cache)
+        etag = get_fingerprint_index(self.client, 'data')[self.key]['ETag']
+        self.client.calls = {}
+        self.assertEqual(first, fetch_fingerprint(self.client, 'data', self.name, self.cache, etag))
+        self.assertNotIn('get_object', self.client.calls)
+
+    def test_unknown_etag_is_revalidated(self):
+        first = fetch_fingerprint(self.client, 'data', self.name, self.cache)
+        self.assertEqual(first, fetch_fingerprint(self.client, 'data', self.name, self.cache))
+        self.assertEqual(2, self.client.calls['get_object'])
+
+        self.client.buckets['data'][self.key] = b'Key fingerprint = changed'
+        self.assertEqual('Key fingerprint = changed', fetch_fingerprint(self.client, 'data', self.name, self.cache))
+        self.assertEqual('Key fingerprint = changed', self.cache.get(self.key)[1])
+
+    def test_missing_fingerprints_are_not_cached(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            entry = generate_entry(self.client, 'data', 'PublicKeys/Nobody.pub.txt', None, self.cache)
+        self.assertIsNone(entry.fingerprint)
+        self.assertEqual([], os.listdir(self.directory.name))
+
+    def test_evict_by_age(self):
+        self.cache.put(self.key, '"etag"', 'body')
+        self.assertEqual(0, self.cache.evict())
+        self.assertEqual(1, self.cache.evict(time.time() + DEFAULT_MAX_AGE))
+        self.assertIsNone(self.cache.get(self.key))
+
+    def test_evict_by_size(self):
+        for i in range(5):
+            self.cache.put(f'Fingerprints/{i}.fpr.txt', '"etag"', 'x' * 100)
+            os.utime(self.cache.path(f'Fingerprints/{i}.fpr.txt'), (i, time.time() - 10 + i))
+        # room for two entries, so the three least recently used are evicted
+        entry_size = os.path.getsize(self.cache.path('Fingerprints/0.fpr.txt'))
+        cache = FingerprintCache(self.directory.name, max_bytes=entry_size * 2)
+        self.assertEqual(3, cache.evict())
+        self.assertIsNone(cache.get('Fingerprints/0.fpr.txt'))
+        self.assertIsNotNone(cache.get('Fingerprints/4.fpr.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import unittest
+
+from fingerprint_parser import *
+from pgp_manager import decode_fingerprint
+from benchmarks.bench_parse import create_corpus, legacy_parse_email, legacy_parse_fingerprint
+
+EDGE_CASE = os.path.join(os.path.dirname(__file__), 'edge_case.fpr.txt')
+
+
+class TestFingerprintParser(unittest.TestCase):
+    def setUp(self) -> None:
+        self.multiple_uids = (
+            'pub   4096R/85FBBD09 2019-03-11\n'
+            '      Key fingerprint = 6FD2 E4C9 71AD B9BB 1573  85EA 383B C341 85FB BD09\n'
+            'uid       [ unknown] Kate Whalen <Kate.Whalen@theguardian.com>\n'
+            'uid       [ unknown] Kate Whalen (personal) <kate@example.org>\n'
+            'sub   2048R/8FA007E8 2019-03-11\n'
+        )
+        with open(EDGE_CASE, 'rb') as fobj:
+            self.edge_case_bytes = fobj.read()
+
+    def tearDown(self) -> None:
+        pass
+
+    def test_parse_multiple_uids(self):
+        record = parse_fingerprint_file(self.multiple_uids)
+        self.assertEqual('6FD2 E4C9 71AD B9BB 1573  85EA 383B C341 85FB BD09', record.fingerprint)
+        self.assertEqual('Kate.Whalen@theguardian.com', record.email)
+        self.assertEqual((
+            Uid('Kate Whalen', 'Kate.Whalen@theguardian.com'),
+            Uid('Kate Whalen (personal)', 'kate@example.org')
+        ), record.uids)
+
+    def test_records_are_immutable_tuples(self):
+        record = parse_fingerprint_file(self.multiple_uids)
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertFalse(hasattr(record.uids[0], '__dict__'))
+        with self.assertRaises(AttributeError):
+            record.email = 'kate@example.org'
+        self.assertEqual({record}, {parse_fingerprint_file(self.multiple_uids)})
+
+    def test_parse_edge_case(self):
+        record = parse_fingerprint_file(self.edge_case_bytes.decode())
+        self.assertEqual('6FD2 E4C9 71AD B9BB 1573  85EA 383B C341 85FB BD09', record.fingerprint)
+        self.assertEqual('edge.case@guardian.co.uk', record.email)
+        self.assertEqual((Uid('', 'edge.case@guardian.co.uk'),), record.uids)
+
+    def test_parse_bare_fingerprint(self):
+        record = parse_fingerprint_file('6FD2 E4C9 71AD B9BB 1573  85EA 383B C341 85FB BD09')
+        self.assertEqual('6FD2 E4C9 71AD B9BB 1573  85EA 383B C341 85FB BD09', record.fingerprint)
+        self.assertEqual('', record.email)
+
+    def test_parse_missing_fingerprint(self):
+        self.assertEqual(EMPTY_RECORD, parse_fingerprint_file(None))
+
+    def test_parse_fingerprint_files(self):
+        records = parse_fingerprint_files([self.multiple_uids, None, self.edge_case_bytes.decode()])
+        self.assertEqual(['Kate.Whalen@theguardian.com', '', 'edge.case@guardian.co.uk'],
+                         [record.email for record in records])
+
+
+class TestDecodedParsing(unittest.TestCase):
+    def setUp(self) -> None:
+        self.corpus = create_corpus(50)
+
+    def tearDown(self) -> None:
+        pass
+
+    def test_decoded_bodies_parse_the_same_as_before(self):
+        for body in self.corpus:
+            record = parse_fingerprint_file(decode_fingerprint(body))
+            self.assertEqual(legacy_parse_fingerprint(str(body)), record.fingerprint)
+            self.assertEqual(legacy_parse_email(str(body)), record.email)
+
+    def test_decoded_body_keeps_every_uid(self):
+        body = (
+            'pub   4096R/85FBBD09 2019-03-11\n'
+            'uid       [ unknown] Zoë Example <zoe@theguardian.com>\n'
+            'uid       [ unknown] zoe.example@guardian.co.uk\n'
+        ).encode('utf-8')
+        record = parse_fingerprint_file(decode_fingerprint(body))
+        self.assertEqual((
+            Uid('Zoë Example', 'zoe@theguardian.com'),
+            Uid('', 'zoe.example@guardian.co.uk')
+        ), record.uids)
+        # the old parser could only see the first email and mangled non-ASCII names
+        self.assertNotIn('Zoë', str(body))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import base64
+import json
+import unittest
+
+from key_directory import *
+
+ARMORED_KEY = """-----BEGIN PGP PUBLIC KEY BLOCK-----
+Version: GnuPG v2
+
+bWRhdGEgZm9yIHRo
+ZSBrZXk=
+=oZ6r
+-----END PGP PUBLIC KEY BLOCK-----
+"""
+
+
+class TestKeyDirectory(unittest.TestCase):
+    def test_wkd_key(self):
+        # the example from the Web Key Directory draft
+        self.assertEqual('.well-known/openpgpkey/example.org/hu/iy9q119eutrkn8s1mk4r39qejnbu3n5q',
+                         wkd_key('Joe.Doe@Example.ORG'))
+
+    def test_wkd_key_rejects_invalid_addresses(self):
+        self.assertIsNone(wkd_key('not an address'))
+        self.assertIsNone(wkd_key('@theguardian.com'))
+        self.assertIsNone(wkd_key('a@b@theguardian.com'))
+
+    def test_dearmor(self):
+        self.assertEqual(b'mdata for the key', dearmor(ARMORED_KEY))
+
+    def test_dearmor_without_headers(self):
+        armored = f'{ARMOR_BEGIN}\n\n{base64.b64encode(b"key").decode()}\n{ARMOR_END}'
+        self.assertEqual(b'key', dearmor(armored))
+
+    def test_dearmor_rejects_invalid_keys(self):
+        self.assertIsNone(dearmor(None))
+        self.assertIsNone(dearmor('new key'))
+        self.assertIsNone(dearmor(f'{ARMOR_BEGIN}\n\nnot base64!\n{ARMOR_END}'))
+
+    def test_build_wkd(self):
+        files = build_wkd([
+            ('Kate.Whalen@theguardian.com', ARMORED_KEY),
+            ('kate.whalen@theguardian.com', ARMORED_KEY),
+            ('edge.case@guardian.co.uk', ARMORED_KEY),
+            ('', ARMORED_KEY),
+            ('missing.key@theguardian.com', None)
+        ])
+        self.assertEqual({
+            '.well-known/openpgpkey/theguardian.com/policy': b'',
+            wkd_key('kate.whalen@theguardian.com'): b'mdata for the key',
+            '.well-known/openpgpkey/guardian.co.uk/policy': b'',
+            wkd_key('edge.case@guardian.co.uk'): b'mdata for the key'
+        }, files)
+
+    def test_build_directory(self):
+        directory = build_directory([{'name': 'Kate Whalen', 'email': 'kate@theguardian.com'}])
+        self.assertNotIn(' ', directory.replace('Kate Whalen', ''))
+        self.assertEqual({'keys': [{'name': 'Kate Whalen', 'email': 'kate@theguardian.com'}]}, json.loads(directory))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,16 @@
 import unittest
+import contextlib
+import gzip
+import hashlib
+import json
+import locale
+import io
+import tempfile
+
+from unittest import mock
 
 from pgp_listing import *
+from benchmarks.fake_s3 import FakeS3Client, FakeSession, create_directory
 
 EDGE_CASE = os.path.join(os.path.dirname(__file__), 'edge_case.fpr.txt')
 
@@ -100,5 +110,332 @@ class TestSortingEntries(unittest.TestCase):
             ]))
 
 
+class TestRecords(unittest.TestCase):
+    def test_records_are_immutable(self):
+        entry = EnhancedEntry('Kate', 'Whalen', 'whalen pk', 'whalen fp', 'email@example')
+        with self.assertRaises(AttributeError):
+            entry.last_name = 'Cutler'
+        with self.assertRaises(AttributeError):
+            Entry('Kate Whalen', 'whalen pk', None).fingerprint = 'whalen fp'
+        with self.assertRaises(AttributeError):
+            Group('W', [entry]).heading = 'C'
+
+    def test_records_have_no_instance_dict(self):
+        entry = EnhancedEntry('Kate', 'Whalen', 'whalen pk', 'whalen fp', 'email@example')
+        for record in [entry, Entry('Kate Whalen', 'whalen pk', None), Group('W', [entry])]:
+            self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_groups_are_hashable(self):
+        entry = EnhancedEntry('Kate', 'Whalen', 'whalen pk', 'whalen fp', 'email@example')
+        group = Group('W', [entry])
+        self.assertEqual((entry,), group.entries)
+        self.assertEqual(hash(group), hash(Group('W', (entry,))))
+        self.assertEqual({group}, {Group('W', [entry]), Group('W', iter([entry]))})
+
+    def test_enhanced_entry_without_raw_email(self):
+        entry = EnhancedEntry('Kate', 'Whalen', 'whalen pk', 'whalen fp', 'email@example')
+        self.assertEqual('', entry.raw_email)
+        self.assertNotEqual(entry, entry._replace(raw_email='kate@example'))
+
+
+class TestEnhancedEntryCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache = EnhancedEntryCache(max_size=2)
+        self.entry = Entry('Kate Whalen', 'PublicKeys/Kate Whalen.pub.txt',
+                           'uid       [ unknown] Kate Whalen <Kate.Whalen@theguardian.com>')
+
+    def enhance(self, entry, etag=None):
+        with mock.patch('pgp_listing.enhance_entry', wraps=enhance_entry) as wrapped:
+            result = self.cache.enhance(entry, etag)
+        return result, wrapped.call_count
+
+    def test_unchanged_entry_is_not_enhanced_again(self):
+        first, calls = self.enhance(self.entry, '"etag"')
+        self.assertEqual(1, calls)
+        second, calls = self.enhance(self.entry, '"etag"')
+        self.assertEqual(0, calls)
+        self.assertIs(first, second)
+        self.assertEqual(enhance_entry(self.entry), second)
+
+    def test_changed_fingerprint_is_enhanced_again(self):
+        self.enhance(self.entry, '"etag"')
+        _, calls = self.enhance(self.entry._replace(fingerprint='changed'), '"changed etag"')
+        self.assertEqual(1, calls)
+
+    def test_fingerprint_is_hashed_without_an_etag(self):
+        self.enhance(self.entry)
+        self.assertEqual(0, self.enhance(self.entry)[1])
+        self.assertEqual(1, self.enhance(self.entry._replace(fingerprint='changed'))[1])
+
+    def test_least_recently_used_entry_is_evicted(self):
+        others = [Entry(f'Contact {i}', f'PublicKeys/Contact {i}.pub.txt', None) for i in range(2)]
+        self.enhance(self.entry, '"etag"')
+        self.enhance(others[0])
+        self.enhance(self.entry, '"etag"')
+        self.enhance(others[1])
+
+        self.assertEqual(2, len(self.cache.entries))
+        self.assertEqual(0, self.enhance(self.entry, '"etag"')[1])
+        self.assertEqual(1, self.enhance(others[0])[1])
+
+
+class TestGroupEntries(unittest.TestCase):
+    def entry(self, other_names, last_name):
+        return EnhancedEntry(other_names, last_name, f'{last_name} pk', f'{last_name} fp', 'email@example')
+
+    def names(self, groups):
+        return [(group.heading, [f'{entry.other_names} {entry.last_name}' for entry in group.entries])
+                for group in groups]
+
+    def test_one_character_last_names_are_kept(self):
+        result = group_entries([self.entry('Malcolm', 'X'), self.entry('Kate', 'Whalen')])
+        self.assertEqual([('W', ['Kate Whalen']), ('X', ['Malcolm X'])], self.names(result))
+
+    def test_accents_and_case_are_ignored(self):
+        result = group_entries([
+            self.entry('Jan', 'Östberg'), self.entry('Ana', 'Ortiz'), self.entry('Bob', 'oakley'),
+            self.entry('Élodie', 'Abbott'), self.entry('Emma', 'Abbott'), self.entry('Zoë', 'Ábel')
+        ])
+        self.assertEqual([
+            ('A', ['Élodie Abbott', 'Emma Abbott', 'Zoë Ábel']),
+            ('O', ['Bob oakley', 'Ana Ortiz', 'Jan Östberg'])
+        ], self.names(result))
+
+    def test_order_does_not_depend_on_input_order(self):
+        entries = [self.entry('Kate', 'Whalen'), self.entry('kate', 'Whalen'), self.entry('Káte', 'Whalen')]
+        self.assertEqual(self.names(group_entries(entries)), self.names(group_entries(reversed(entries))))
+
+    def test_locale_aware_collation(self):
+        previous = locale.setlocale(locale.LC_COLLATE)
+        self.addCleanup(locale.setlocale, locale.LC_COLLATE, previous)
+        self.assertTrue(set_collation_locale('C.UTF-8'))
+
+        # the C locale compares code points, so Ö keeps its own heading after Z
+        result = group_entries([self.entry('Jan', 'Östberg'), self.entry('Ana', 'Ortiz'), self.entry('Kate', 'Zeta')],
+                               locale_aware=True)
+        self.assertEqual([('O', ['Ana Ortiz']), ('Z', ['Kate Zeta']), ('Ö', ['Jan Östberg'])], self.names(result))
+
+    def test_no_collation_locale(self):
+        self.assertFalse(set_collation_locale(None))
+
+
+class TestSearchIndex(unittest.TestCase):
+    def test_normalize_name(self):
+        self.assertEqual(normalize_name('José Álvarez'), 'jose alvarez')
+        # matches what the filter script makes of the same name typed into the page
+        self.assertEqual(normalize_name('Strauß'), 'strauß')
+        self.assertEqual(normalize_name('STRAUß'), 'strauß')
+
+    def test_build_search_index(self):
+        groups = [
+            Group('B', [EnhancedEntry('Michael', 'Barton', 'barton pk', 'barton fp', 'email@example')]),
+            Group('W', [
+                EnhancedEntry('Kate', 'Whalen', 'whalen pk', 'whalen fp', 'email@example'),
+                EnhancedEntry('Zoë', 'Wright', 'wright pk', 'wright fp', 'email@example')
+            ])
+        ]
+        self.assertEqual(build_search_index(groups), [['michael barton'], ['kate whalen', 'zoe wright']])
+
+    def test_render_page_embeds_escaped_index(self):
+        groups = iter([Group('B', [EnhancedEntry('</script>', 'Barton', 'barton pk', 'barton fp', 'email@example')])])
+        page = render_page('pgp/', groups)
+
+        self.assertIn('\\u003c/script\\u003e barton', page)
+        self.assertIn('&lt;/script&gt; Barton', page)
+
+
+class TestShardedOutput(unittest.TestCase):
+    def setUp(self) -> None:
+        self.groups = [
+            Group('B', [EnhancedEntry('Michael', 'Barton', 'barton pk', 'barton fp', 'email@example')]),
+            Group('W', [EnhancedEntry('Kate', 'Whalen', 'whalen pk', 'whalen fp', 'email@example')])
+        ]
+
+    def test_render_shards(self):
+        pages = render_shards('pgp/', '/pgp/', iter(self.groups))
+        self.assertEqual(['index.html', 'letters/B.html', 'letters/W.html'], list(pages))
+
+        self.assertIn("href='pgp/letters/W.html'", pages['index.html'])
+        self.assertNotIn('Whalen', pages['index.html'])
+        self.assertIn('Barton', pages['letters/B.html'])
+        self.assertNotIn('Whalen', pages['letters/B.html'])
+        self.assertIn("href='/pgp/letters/W.html'", pages['letters/B.html'])
+
+    def test_shard_key_is_quoted_in_links(self):
+        pages = render_shards('pgp/', '/pgp/', [Group('Ö', [EnhancedEntry('Jan', 'Östberg', 'pk', 'fp', 'email')])])
+        self.assertIn('letters/Ö.html', pages)
+        self.assertIn("href='pgp/letters/%C3%96.html'", pages['index.html'])
+
+
+class TestLambdaHandler(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = FakeS3Client({'data': create_directory(5), 'public': {}})
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.environ = mock.patch.dict(os.environ, {
+            'DATA_BUCKET_NAME': 'data',
+            'PUBLIC_BUCKET_NAME': 'public',
+            'FINGERPRINT_CACHE_DIR': self.cache_dir.name
+        })
+        self.session = mock.patch('pgp_manager.create_session', return_value=FakeSession(self.client))
+        get_aws_session.cache_clear()
+        get_publisher.cache_clear()
+        get_enhanced_entry_cache.cache_clear()
+        self.environ.start()
+        self.session.start()
+
+    def tearDown(self) -> None:
+        self.session.stop()
+        self.environ.stop()
+        self.cache_dir.cleanup()
+
+    def run_handler(self):
+        self.client.calls = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            lambda_handler({}, None)
+
+    def test_unchanged_listing_is_not_published_again(self):
+        self.run_handler()
+        self.assertEqual(5, self.client.calls['copy_object'])
+        self.assertIn('index.html', self.client.buckets['public'])
+
+        self.run_handler()
+        self.assertNotIn('copy_object', self.client.calls)
+        # only the manifest is read and written
+        self.assertEqual(1, self.client.calls['get_object'])
+        self.assertEqual(1, self.client.calls['put_object'])
+
+    def page_digest(self):
+        return json.loads(self.client.buckets['public']['manifest.json'])['index.html']['ETag']
+
+    def test_changed_rendering_is_published_again(self):
+        self.run_handler()
+        digest = self.page_digest()
+        with mock.patch('pgp_listing.render_version', return_value='new templates'), \
+                mock.patch('pgp_listing.render_page', wraps=render_page) as render:
+            self.run_handler()
+        render.assert_called_once()
+        self.assertNotIn('copy_object', self.client.calls)
+        self.assertNotEqual(digest, self.page_digest())
+
+    def test_changed_collation_locale_is_published_again(self):
+        self.run_handler()
+        digest = self.page_digest()
+        with mock.patch.dict(os.environ, {'COLLATION_LOCALE': 'C'}):
+            self.run_handler()
+        self.assertNotEqual(digest, self.page_digest())
+
+    def test_render_version(self):
+        self.assertEqual(render_version(), render_version())
+        self.assertNotEqual(render_version(), render_version('en_GB.UTF-8'))
+
+    def test_changed_key_is_published_again(self):
+        self.run_handler()
+        self.client.buckets['data']['PublicKeys/Contact00001 Surname00001.pub.txt'] = b'new key'
+
+        self.run_handler()
+        self.assertEqual(1, self.client.calls['copy_object'])
+        # the rendered page is identical, so only the key directory with the new ETag and the manifest are uploaded
+        self.assertEqual(2, self.client.calls['put_object'])
+
+    def test_changed_fingerprint_is_published_again(self):
+        self.run_handler()
+        self.client.buckets['data']['Fingerprints/Contact00004 Surname00004.fpr.txt'] = \
+            b'Key fingerprint = 6FD2 E4C9 71AD B9BB 1573  85EA 383B C341 85FB BD09'
+
+        self.run_handler()
+        self.assertNotIn('copy_object', self.client.calls)
+        # the page, the key directory and the manifest
+        self.assertEqual(3, self.client.calls['put_object'])
+        self.assertIn(b'85FB BD09', gzip.decompress(self.client.buckets['public']['index.html']))
+
+    def test_page_refers_to_hashed_assets(self):
+        self.run_handler()
+        index_page = gzip.decompress(self.client.buckets['public']['index.html']).decode()
+        stylesheets = [key for key in self.client.buckets['public'] if key.endswith('.css')]
+        self.assertEqual(2, len(stylesheets))
+        for key in stylesheets:
+            self.assertRegex(key, r'^static/[\w.]+\.[0-9a-f]{12}\.css$')
+            self.assertIn(f'href="pgp/{key}"', index_page)
+
+    def test_key_directory_is_published(self):
+        self.run_handler()
+        public = self.client.buckets['public']
+        directory = json.loads(gzip.decompress(public['directory.json']))
+        self.assertEqual(5, len(directory['keys']))
+        self.assertEqual({
+            'name': 'Contact00001 Surname00001',
+            'fingerprint': '6FD2 E4C9 71AD B9BB 1573  85EA 383B C341 85FB 0001',
+            'email': 'contact1@theguardian.com',
+            'url': '/pgp/PublicKeys/Contact00001%20Surname00001.pub.txt',
+            'etag': hashlib.md5(self.client.buckets['data']['PublicKeys/Contact00001 Surname00001.pub.txt']).hexdigest()
+        }, directory['keys'][1])
+
+        # the contact without a fingerprint has no email address, so is not in the Web Key Directory
+        wkd_keys = sorted(key for key in public if key.startswith(key_directory.WKD_PREFIX))
+        self.assertEqual(5, len(wkd_keys))
+        self.assertIn('.well-known/openpgpkey/theguardian.com/policy', wkd_keys)
+        self.assertEqual(b'Contact00001 Surname00001', public[key_directory.wkd_key('contact1@theguardian.com')])
+
+    def test_unchanged_entries_are_not_enhanced_again(self):
+        self.run_handler()
+        self.client.buckets['data']['Fingerprints/Contact00004 Surname00004.fpr.txt'] = b'changed'
+
+        with mock.patch('pgp_listing.enhance_entry', wraps=enhance_entry) as wrapped:
+            self.run_handler()
+        self.assertEqual(['Contact00004 Surname00004'], [args[0].name for args, _ in wrapped.call_args_list])
+
+    def test_session_is_reused_between_invocations(self):
+        self.run_handler()
+        self.run_handler()
+        self.assertEqual(1, pgp_manager.create_session.call_count)
+
+    def test_removed_key_is_deleted_from_public_bucket(self):
+        self.run_handler()
+        del self.client.buckets['data']['PublicKeys/Contact00002 Surname00002.pub.txt']
+
+        wkd_key = key_directory.wkd_key('contact2@theguardian.com')
+        self.assertIn(wkd_key, self.client.buckets['public'])
+
+        self.run_handler()
+        self.assertNotIn('PublicKeys/Contact00002 Surname00002.pub.txt', self.client.buckets['public'])
+        self.assertNotIn(wkd_key, self.client.buckets['public'])
+
+    def test_sharded_output_only_uploads_changed_letters(self):
+        self.client.buckets['data'].update({
+            'PublicKeys/Kate Whalen.pub.txt': b'-----BEGIN PGP PUBLIC KEY BLOCK-----',
+            'Fingerprints/Kate Whalen.fpr.txt': b'uid       [ unknown] Kate Whalen <kate@theguardian.com>\n'
+        })
+        with mock.patch.dict(os.environ, {'SHARDED_OUTPUT': 'true'}):
+            self.run_handler()
+            self.assertIn('letters/S.html', self.client.buckets['public'])
+            self.assertIn('letters/W.html', self.client.buckets['public'])
+            index_page = gzip.decompress(self.client.buckets['public']['index.html'])
+            self.assertNotIn(b'Whalen', index_page)
+
+            self.client.buckets['data']['Fingerprints/Kate Whalen.fpr.txt'] = \
+                b'Key fingerprint = 6FD2 E4C9 71AD B9BB 1573  85EA 383B C341 85FB BD09'
+            before = dict(self.client.buckets['public'])
+            self.run_handler()
+
+        changed = [key for key, body in self.client.buckets['public'].items() if before.get(key) != body]
+        self.assertEqual(['directory.json', 'letters/W.html', 'manifest.json'], sorted(changed))
+
+    def test_switching_off_sharded_output_deletes_letters(self):
+        with mock.patch.dict(os.environ, {'SHARDED_OUTPUT': 'true'}):
+            self.run_handler()
+        self.assertIn('letters/S.html', self.client.buckets['public'])
+
+        self.run_handler()
+        self.assertNotIn('letters/S.html', self.client.buckets['public'])
+        self.assertIn(b'Surname00001', gzip.decompress(self.client.buckets['public']['index.html']))
+
+    def test_old_keys_are_refreshed_before_they_expire(self):
+        with mock.patch('time.time', return_value=1570701600):
+            self.run_handler()
+        with mock.patch('time.time', return_value=1570701600 + pgp_manager.REFRESH_AFTER):
+            self.run_handler()
+        self.assertEqual(5, self.client.calls['copy_object'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,191 @@
+import unittest
+import contextlib
+import gzip
+import io
+
+from unittest import mock
+
+from pgp_manager import *
+from benchmarks.fake_s3 import FakeS3Client, FakeSession, create_directory
+
+
+class TestGetAllEntries(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = FakeS3Client({'data': create_directory(25)})
+
+    def tearDown(self) -> None:
+        pass
+
+    def test_concurrent_fetch_matches_serial_fetch(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            serial = get_all_entries(self.client, 'data', max_workers=1)
+            concurrent = get_all_entries(self.client, 'data', max_workers=8)
+        self.assertEqual(25, len(serial))
+        self.assertEqual(serial, concurrent)
+
+    def test_missing_fingerprint_is_logged(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            entries = get_all_entries(self.client, 'data', max_workers=4)
+        self.assertIsNone(entries[-1].fingerprint)
+        self.assertIn('NoSuchKey: Fingerprints/Contact00024 Surname00024.fpr.txt', output.getvalue())
+
+    def test_iter_entries_consumes_keys_lazily(self):
+        consumed = []
+
+        def keys():
+            for key in get_matching_s3_keys(self.client, 'data', 'PublicKeys/'):
+                consumed.append(key)
+                yield key
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            entries = iter_entries(self.client, 'data', keys(), max_workers=2)
+            first = next(entries)
+            self.assertEqual('Contact00000 Surname00000', first.name)
+            self.assertLessEqual(len(consumed), 4)
+            self.assertEqual(24, len(list(entries)))
+
+    def test_only_existing_fingerprints_are_fetched(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            get_all_entries(self.client, 'data', max_workers=1)
+        self.assertEqual(20, self.client.calls['get_object'])
+        self.assertEqual(2, self.client.calls['list_objects_v2'])
+
+    def test_get_fingerprint_index(self):
+        index = get_fingerprint_index(self.client, 'data')
+        self.assertEqual(20, len(index))
+        self.assertIn('Fingerprints/Contact00000 Surname00000.fpr.txt', index)
+
+
+class TestUploads(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = FakeS3Client({'public': {}})
+
+    def tearDown(self) -> None:
+        pass
+
+    def upload_static(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return upload_files(self.client, 'public', 'static/', 'static/')
+
+    def test_unchanged_files_are_not_uploaded_again(self):
+        first = self.upload_static()
+        self.assertIn('static/public.css', first)
+        self.assertEqual([], self.upload_static())
+
+    def test_changed_files_are_uploaded_again(self):
+        self.upload_static()
+        self.client.buckets['public']['static/public.css'] = b'body {}'
+        self.assertEqual(['static/public.css'], self.upload_static())
+
+    def test_upload_html_compares_with_published_objects(self):
+        self.assertTrue(upload_html(self.client, 'public', 'index.html', '<html></html>', {}))
+        published = get_published_objects(self.client, 'public')
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(upload_html(self.client, 'public', 'index.html', '<html></html>', published))
+        self.assertTrue(upload_html(self.client, 'public', 'index.html', '<html>changed</html>', published))
+
+    def test_publish_static_assets(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            assets = publish_static_assets(self.client, 'public', 'static/', 'static/')
+            self.assertEqual(assets, publish_static_assets(self.client, 'public', 'static/', 'static/'))
+        self.assertEqual(len(assets), self.client.calls['put_object'])
+
+        with open('static/public.css', 'rb') as fobj:
+            css = fobj.read()
+        published = self.client.buckets['public']['static/' + assets['public.css']]
+        self.assertEqual(css, gzip.decompress(published))
+        self.assertEqual(gzip_bytes(css), published)
+
+    def test_needs_upload_refreshes_old_objects(self):
+        self.client.buckets['public']['index.html'] = b'<html></html>'
+        published = get_published_objects(self.client, 'public')
+        now = published['index.html']['LastModified'].timestamp()
+        self.assertFalse(needs_upload(published, 'index.html', b'<html></html>', now))
+        self.assertTrue(needs_upload(published, 'index.html', b'<html></html>', now + REFRESH_AFTER))
+
+
+class TestCopyKeys(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = FakeS3Client({'data': create_directory(10), 'public': {}})
+        self.entries = [Entry(parse_name(key), key, None) for key in get_matching_s3_keys(self.client, 'data', 'PublicKeys/')]
+
+    def tearDown(self) -> None:
+        pass
+
+    def test_copy_keys_to_public_bucket(self):
+        results = copy_keys_to_public_bucket(self.client, 'data', 'public', self.entries, max_workers=4)
+        self.assertEqual(10, len(results))
+        self.assertTrue(all(error is None for error in results.values()))
+        self.assertEqual(10, len(self.client.buckets['public']))
+
+    def test_copy_failures_are_reported_per_key(self):
+        missing = Entry('Missing Person', 'PublicKeys/Missing Person.pub.txt', None)
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = copy_keys_to_public_bucket(self.client, 'data', 'public', self.entries + [missing])
+        self.assertEqual('NoSuchKey', results['PublicKeys/Missing Person.pub.txt'])
+        self.assertEqual(10, len([error for error in results.values() if error is None]))
+
+    def test_private_files_are_not_copied(self):
+        private = Entry('Private Person', 'PublicKeys/Private Person.sec.txt', None)
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = copy_keys_to_public_bucket(self.client, 'data', 'public', [private])
+        self.assertEqual({}, results)
+
+
+class TestDeleteKeys(unittest.TestCase):
+    def setUp(self) -> None:
+        public = {f'PublicKeys/Old Contact{i}.pub.txt': b'old key' for i in range(1500)}
+        public['PublicKeys/Current Contact.pub.txt'] = b'key'
+        public['index.html'] = b'<html></html>'
+        self.client = FakeS3Client({'public': public})
+        self.listing = {'PublicKeys/Current Contact.pub.txt': {}}
+
+    def tearDown(self) -> None:
+        pass
+
+    def test_find_orphaned_keys(self):
+        published = get_published_objects(self.client, 'public')
+        orphans = find_orphaned_keys(published, self.listing)
+        self.assertEqual(1500, len(orphans))
+        self.assertNotIn('PublicKeys/Current Contact.pub.txt', orphans)
+        self.assertNotIn('index.html', orphans)
+
+    def test_delete_keys_in_batches(self):
+        orphans = find_orphaned_keys(get_published_objects(self.client, 'public'), self.listing)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual({}, delete_keys(self.client, 'public', orphans))
+        self.assertEqual(2, self.client.calls['delete_objects'])
+        self.assertEqual({'PublicKeys/Current Contact.pub.txt', 'index.html'}, set(self.client.buckets['public']))
+
+    def test_delete_keys_dry_run(self):
+        orphans = find_orphaned_keys(get_published_objects(self.client, 'public'), self.listing)
+        with contextlib.redirect_stdout(io.StringIO()):
+            delete_keys(self.client, 'public', orphans, dry_run=True)
+        self.assertNotIn('delete_objects', self.client.calls)
+        self.assertEqual(1502, len(self.client.buckets['public']))
+
+
+class TestPublisher(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = FakeS3Client({'data': create_directory(5), 'public': {}})
+        self.session = mock.Mock(wraps=FakeSession(self.client))
+
+    def tearDown(self) -> None:
+        pass
+
+    def test_one_client_is_shared_by_every_phase(self):
+        publisher = Publisher(self.session, max_workers=32)
+        with contextlib.redirect_stdout(io.StringIO()):
+            listing = publisher.get_listing('data')
+            entries = list(publisher.generate_entries('data', listing))
+            publisher.copy_keys('data', 'public', entries)
+            publisher.upload_files('public', 'static/', 'static/')
+            publisher.upload_html('public', 'index.html', '<html></html>')
+        self.session.client.assert_called_once()
+        self.assertEqual(32, self.session.client.call_args[1]['config'].max_pool_connections)
+        self.assertEqual(5, self.client.calls['copy_object'])
+
+
+if __name__ == '__main__':
+    unittest.main()
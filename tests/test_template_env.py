@@ -0,0 +1,31 @@
+import tempfile
+import unittest
+
+from template_env import *
+
+
+class TestTemplateEnvironment(unittest.TestCase):
+    def setUp(self) -> None:
+        self.compiled_dir = tempfile.TemporaryDirectory()
+        compile_templates(self.compiled_dir.name)
+
+    def tearDown(self) -> None:
+        self.compiled_dir.cleanup()
+
+    def test_compiled_environment_uses_module_loader(self):
+        compiled = create_environment(self.compiled_dir.name)
+        self.assertIsInstance(compiled.loader, ModuleLoader)
+        self.assertFalse(compiled.auto_reload)
+
+    def test_missing_compiled_templates_fall_back_to_filesystem(self):
+        self.assertIsInstance(create_environment('/nonexistent').loader, FileSystemLoader)
+
+    def test_compiled_templates_render_the_same(self):
+        source = create_environment('/nonexistent').get_template('securedrop.html')
+        compiled = create_environment(self.compiled_dir.name).get_template('securedrop.html')
+        context = {'securedrop_url': 'example.onion', 'path': '', 'passes_healthcheck': True}
+        self.assertEqual(source.render(**context), compiled.render(**context))
+
+
+if __name__ == '__main__':
+    unittest.main()